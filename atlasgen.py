@@ -0,0 +1,81 @@
+#!/bin/python3
+
+## CHIP'S OCEAN GAME (COG) ATLAS GENERATOR
+##
+## Pregenerates the contact field for a rectangular region of the ocean and
+## writes it out as an atlas file (see lib/atlas.py). Point 'atlasfile' in
+## the main config at the result and sweeps inside the region will be read
+## from disk instead of generated.
+##
+## USAGE: ./atlasgen.py X1 Y1 X2 Y2 [-o FILE] [--hull HULL] [--workers N]
+##        (X1,Y1 and X2,Y2 are opposite corners of the region, in grid squares)
+
+
+# IMPORTS AND CONSTANTS
+import argparse
+import os
+from math import floor
+from multiprocessing import Pool
+
+import lib.worldgen as wg
+import lib.atlas as atlas
+
+SENSORS = [ "radar", "sonar" ]
+
+
+# FUNCTIONS
+def initWorker(hull):
+    # Runs once in each worker process so that the hull override (if any)
+    # also applies when the pool doesn't fork.
+    wg.conf['hull'] = hull
+    wg.hullKey = wg.makeHullKey(hull)
+    return
+
+def genTile(job):
+    # Generates a single tile. Takes a (sensor type, tx, ty) tuple, returns a
+    # tuple of the atlas key (sensor code, tx, ty) and the tile's (x,y) list.
+    type, tx, ty = job
+    contacts = wg.generateBox(wg.tileBox(tx, ty), type)
+    return ((wg.SENSORCODES[type], tx, ty), [(c[0], c[1]) for c in contacts])
+
+
+# MAIN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pregenerate a COG world atlas.")
+    parser.add_argument("coords", type=int, nargs=4, metavar="N",
+                        help="opposite corners of the region: X1 Y1 X2 Y2")
+    parser.add_argument("-o", "--out", default="atlas.cog",
+                        help="atlas file to write (default: %(default)s)")
+    parser.add_argument("--hull", default=wg.conf['hull'],
+                        help="hull number to generate for (default: from main.conf)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    initWorker(args.hull)
+    x1, y1, x2, y2 = args.coords
+    region = [ floor(min(x1, x2)/wg.TILESIZE), floor(min(y1, y2)/wg.TILESIZE),
+               floor(max(x1, x2)/wg.TILESIZE), floor(max(y1, y2)/wg.TILESIZE) ]
+    jobs = [ (type, tx, ty) for type in SENSORS
+                            for ty in range(region[1], region[3]+1)
+                            for tx in range(region[0], region[2]+1) ]
+    print(f"Generating {len(jobs)} tiles for {args.hull} ({wg.sweepMode} engine) "
+          f"using {args.workers} workers...")
+
+    tiles = {}
+    with Pool(args.workers, initializer=initWorker, initargs=(args.hull,)) as pool:
+        for key, contacts in pool.imap_unordered(genTile, jobs, chunksize=4):
+            tiles[key] = contacts
+            if len(tiles) % 100 == 0 or len(tiles) == len(jobs):
+                print(f"    {len(tiles)}/{len(jobs)} tiles done")
+
+    meta = { "hullKey"  : wg.hullKey,
+             "mode"     : wg.sweepMode,
+             "tileSize" : wg.TILESIZE,
+             "chanceU"  : wg.probs['chanceSurfacePOI'],
+             "chanceL"  : wg.probs['chanceSubPOI'],
+             "region"   : region,
+             "sensors"  : [ wg.SENSORCODES[type] for type in SENSORS ] }
+    atlas.writeAtlas(args.out, meta, tiles)
+    numContacts = sum(len(c) for c in tiles.values())
+    print(f"Wrote {numContacts} contacts to {args.out}")
@@ -6,14 +6,15 @@
 
 
 # IMPORTS AND CONSTANTS
-import praw
 import os
+import argparse
+import importlib
 import logging
 import random
-import json
 import time
 from time import sleep, perf_counter
 from math import floor
+from functools import partial
 
 import lib.AIengine as ai
 import lib.navigation as nav
@@ -21,60 +22,61 @@ import lib.worldgen as wg
 import lib.configManager as cm
 import lib.displayEngine as display
 import lib.dbServices as dbs
+import lib.rngService as rngs
+import lib.routePlanner as route
+import lib.scheduler as sched
 
 confFile = "etc/main.conf"
 
 
 # FUNCTIONS
 def sensorSweep(shipState):
-    # Polls ship's sensors to find new POIs and add them to TO_EXPLORE.
+    # Polls ship's sensors to find new POIs and add them to TO_EXPLORE. Only
+    # the grid squares that came in to range since the last tick get searched.
     contacts = []
-    newconts = []
     shipLoc = (shipState['shipX'], shipState['shipY'])
 
     for sensor in ['radar','sonar']:
         range = nav.computeEffectiveRange(shipState[f"range_{sensor}"], shipState[f"mod_{sensor}"])
-        clist = wg.sensorSweep(shipLoc, range, sensor)
+        clist = wg.sensorSweep(shipLoc, range, sensor, delta=True)
         for c in clist:
             contacts.append(c)
 
-    # Check if a detected contact is already in the DB (both TO_EXPLORE and POI)
-    for contact in contacts:
-        if dbs.lookupEID(contact)==None and dbs.lookupPID(contact)==None:
-            newconts.append(contact)
-
-    dbs.writeContacts(newconts)
+    # Contacts already in the DB (both TO_EXPLORE and POI) get skipped. Most
+    # can be ruled out from memory, so the DB only sees the new ones.
+    newconts = [c for c in contacts if not dbs.isKnown(c)]
+    dbs.ingestContacts(newconts)
+    if conf.get('routeplan', False):
+        route.addContacts(newconts, shipLoc)
     return
 
-def magicCoin(prob):
-    # Randomly returns True according to probability <prob>. If prob is a
-    # string then it is parsed for keywords that map to pre-set probabilities,
-    # such as average chance of hit once per day, once per month, etc. If
-    # prob is an int then it will be taken as a direct value.
+def magicCoin(prob, gen=random):
+    # Randomly returns True with a 1 in <prob> chance, rolled from random
+    # stream <gen>. Things that happen at some rate over time (once a day,
+    # once a month, etc.) are scheduled with sched.EventQueue instead.
     heads = False
-    if isinstance(prob, str):
-        # Note: These numbers are based on the amount of 5-second ticks in a
-        #       given period. e.g., 'daily' is the number of 5s ticks per day.
-        pTable = { "daily"   : 17280,  "bidaily"   : 34560,
-                   "weekly"  : 120960, "biweekly"  : 241920,
-                   "monthly" : 518400, "bimonthly" : 1036800 }
-        p = pTable[prob.lower()]
-    else:
-        p = prob
-
-    if random.randrange(p) == 1:
+    if gen.randrange(prob) == 1:
         heads = True
     return heads
 
-def boldlyGo(shipState):
+def wholeTicks(ticks, gen=random):
+    # Turns a (possibly fractional) number of ticks in to a whole number for
+    # things that happen once per tick, rounding the fraction up or down at
+    # random so it averages out. Returns an int.
+    whole = floor(ticks)
+    if ticks > whole and gen.random() < ticks - whole:
+        whole += 1
+    return whole
+
+def boldlyGo(shipState, gen=random):
     # In certain situations, the captain will decide to "Boldly Go", a.k.a.
     # "choose a random heading and sail off in to the distance." This helps
     # ensure that the ship doesn't just loiter in the same general area forever
     shipLoc = (shipState['shipX'], shipState['shipY'])
     # 240-1680 chosen because that translates to between 1-7 day's journey at 
     # stock speed.
-    distance = random.uniform(240, 1680)
-    heading  = random.uniform(0, 360)
+    distance = gen.uniform(240, 1680)
+    heading  = gen.uniform(0, 360)
 
     x, y = nav.computeTravel(shipLoc, heading, distance)
     targetLoc = getSimpleCoords(x, y)
@@ -83,11 +85,14 @@ def boldlyGo(shipState):
     logging.info(f"Captain has decided to Boldly Go to distant coordinates {targetLoc}!")
     return shipState
 
-def crewActions(shipState):
-    # Decision-making for the crew to be performed on each tick. 
+def crewActions(shipState, ticks=1):
+    # Decision-making for the crew to be performed on each tick. When time is
+    # being skipped, <ticks> is how many ticks' worth of time the step covers
+    # and the crew's per-tick work is scaled to match.
     shipLoc = (shipState['shipX'], shipState['shipY'])  
     maxSPD = shipState['max_spd']  
-    random.seed(wg.makeGridSeed(shipLoc[0], shipLoc[1]))
+    gen = rngs.getStream("crew", shipLoc, shipState['day'], shipState['tStamp'],
+                         legacy=wg.makeGridSeed(shipLoc[0], shipLoc[1]))
     # Captain:
     #    Check if ship is in dire need of something and needs to divert course.
     components = ['hull', 'engine', 'lab', 'bridge']
@@ -97,43 +102,56 @@ def crewActions(shipState):
     if shipState['cargo_fuel']/shipState['fuel_cap'] < 0.333:
         estFuelCost = (shipState['fuel_cap']-shipState['cargo_fuel'])*2
         if shipState['money'] >= estFuelCost:
-            fSrc = dbs.dumpType('offshore platform')
-            fSrc = fSrc + dbs.dumpType('deposit')
-            pid = nav.getClosest(shipLoc, fSrc)
+            fSrc = dbs.nearest(shipLoc, ['offshore platform', 'deposit'])
         else:
-            pid = nav.getClosest(shipLoc, dbs.dumpType('deposit'))
+            fSrc = dbs.nearest(shipLoc, ['deposit'])
+        pid = fSrc[0] if fSrc else None
     if shipState['cargo_food'] <= 105 or shipState['cargo_water'] <= 7000:
         needProvs = True
     for component in components:
         if shipState[f'health_{component}'] <= 25:
             needRepair = True
     if needProvs or needRepair:
-        pid = nav.getClosest(shipLoc, dbs.dumpType('offshore platform'))
+        pSrc = dbs.nearest(shipLoc, ['offshore platform'])
+        pid = pSrc[0] if pSrc else None
     if pid:
         if shipState['trackID'] != dbs.lookupEID((pid[1][0], pid[1][1])):
             dbs.writeContacts([pid[1]])
             shipState['trackID'] = dbs.lookupEID((pid[1][0], pid[1][1]))
             logging.info(f"BRIDGE: Ship in jeopardy! Captain is setting course for EID:{shipState['trackID']} in hopes of getting repairs and/or supplies.")
-    #    Otherwise, choose a track if one isn't already set.
+    #    Otherwise follow the planned route, if route planning is on...
+    if shipState['trackID'] == -1 and conf.get('routeplan', False):
+        stop = route.nextStop(shipState, countPlayers(shipState))
+        if stop is not None:
+            if stop[0] == "platform":
+                dbs.writeContacts([stop[1]])
+            eid = dbs.lookupEID((stop[1][0], stop[1][1]))
+            if eid is not None:
+                shipState['trackID'] = eid
+                logging.info(f"BRIDGE: Captain is following the planned route to {stop[0]} EID:{eid}.")
+    #    ...or choose a track if one isn't already set.
     if shipState['trackID'] == -1:
-        if magicCoin(10): 
-            shipState = boldlyGo(shipState)
+        if magicCoin(10, gen): 
+            shipState = boldlyGo(shipState, gen)
         else:
-            toExplore = dbs.dumpAllContacts()
-            while shipState['trackID'] == -1:
-                candidateContact = random.choice(toExplore)
-                # Limiting range to 480 (2 day's journey @ stock speed) helps
-                # ensure the captain doesn't choose a contact clear on the
-                # other side of the world or anything like that.
-                if nav.computeRange(shipLoc, candidateContact[1]) <= 480:
-                    shipState['trackID'] = candidateContact[0]
-            logging.info(f"BRIDGE: Captain has set course for unexplored contact EID:{shipState['trackID']}.")
+            # Limiting range to 480 (2 day's journey @ stock speed) helps
+            # ensure the captain doesn't choose a contact clear on the
+            # other side of the world or anything like that.
+            toExplore = dbs.withinRadius(shipLoc, 480, ['U', 'L'], table="TO_EXPLORE")
+            if toExplore:
+                toExplore.sort(key=lambda c: c[0])
+                shipState['trackID'] = gen.choice(toExplore)[0]
+                logging.info(f"BRIDGE: Captain has set course for unexplored contact EID:{shipState['trackID']}.")
+            else:
+                shipState = boldlyGo(shipState, gen)
     #    Set course and speed
     contact = dbs.lookupContact(shipState['trackID'])
     shipState['hdg'] = nav.computeBearing(shipLoc, contact)
     shipState['spd'] = maxSPD
-    #    Chance of writing a personal log
-    if magicCoin("bidaily"):
+    #    Chance of writing a personal log. Nobody writes more than one a tick,
+    #    however many times their log came due (a long step can cover a few):
+    #    the extra logs would only say the same thing.
+    if events.happened("log_co"):
         writeOfficialLog(shipState, 'co')
         logging.info(f"{shipState['co']['fTitle']} {shipState['co']['name']} has written a personal log.")
     
@@ -141,14 +159,15 @@ def crewActions(shipState):
     # Repair/maintain components in accordance with component priorities.
     if shipState['cheng']['health'] > 25:
         priorities = ['engine', 'bridge', 'lab', 'dinghy', 'sub']
-        for component in priorities:
-            if 0 < shipState[f'health_{component}'] <= 75:
-                rsrc = 'iron' if component in ['engine','dinghy','sub'] else 'silicon'
-                if shipState[f'cargo_{rsrc}'] > 0:
-                    shipState[f'cargo_{rsrc}'] -= 1
-                    shipState[f'health_{component}'] += 1
-                    break
-    if magicCoin("bidaily") and shipState['cheng']['name'] != "VACANT":
+        for _ in range(wholeTicks(ticks, gen)):
+            for component in priorities:
+                if 0 < shipState[f'health_{component}'] <= 75:
+                    rsrc = 'iron' if component in ['engine','dinghy','sub'] else 'silicon'
+                    if shipState[f'cargo_{rsrc}'] > 0:
+                        shipState[f'cargo_{rsrc}'] -= 1
+                        shipState[f'health_{component}'] += 1
+                        break
+    if events.happened("log_cheng") and shipState['cheng']['name'] != "VACANT":
         writeOfficialLog(shipState, 'cheng')
         logging.info(f"{shipState['cheng']['fTitle']} {shipState['cheng']['name']} has written a personal log.")
     
@@ -161,14 +180,14 @@ def crewActions(shipState):
         if shipState['to_analyze_artifact'] > 0:
             toResearch.append('artifact')
         if len(toResearch) > 0:
-            thing = random.choice(toResearch)
+            thing = gen.choice(toResearch)
             if shipState['health_lab'] > 75:
-                shipState[f'lab_count_{thing}'] -= 1
+                shipState[f'lab_count_{thing}'] -= 1*ticks
             else:
-                shipState[f'lab_count_{thing}'] -= 0.5
+                shipState[f'lab_count_{thing}'] -= 0.5*ticks
             if shipState[f'lab_count_{thing}'] <= 0:
-                shipState = rewardResearch(shipState, thing)
-    if magicCoin("bidaily") and shipState['cso']['name'] != "VACANT":
+                shipState = rewardResearch(shipState, thing, gen)
+    if events.happened("log_cso") and shipState['cso']['name'] != "VACANT":
         writeOfficialLog(shipState, 'cso')
         logging.info(f"{shipState['cso']['fTitle']} {shipState['cso']['name']} has written a personal log.")
     
@@ -177,14 +196,15 @@ def crewActions(shipState):
     # stuff all the way up to 90%
     if shipState['eng']['health'] > 25:
         priorities = ['engine', 'bridge', 'lab', 'dinghy', 'sub']
-        for component in priorities:
-            if 0 < shipState[f'health_{component}'] <= 90:
-                rsrc = 'iron' if component in ['engine','dinghy','sub'] else 'silicon'
-                if shipState[f'cargo_{rsrc}'] > 0:
-                    shipState[f'cargo_{rsrc}'] -= 1
-                    shipState[f'health_{component}'] += 1
-                    break
-    if magicCoin("bidaily") and shipState['eng']['name'] != "VACANT":
+        for _ in range(wholeTicks(ticks, gen)):
+            for component in priorities:
+                if 0 < shipState[f'health_{component}'] <= 90:
+                    rsrc = 'iron' if component in ['engine','dinghy','sub'] else 'silicon'
+                    if shipState[f'cargo_{rsrc}'] > 0:
+                        shipState[f'cargo_{rsrc}'] -= 1
+                        shipState[f'health_{component}'] += 1
+                        break
+    if events.happened("log_eng") and shipState['eng']['name'] != "VACANT":
         writeOfficialLog(shipState, 'eng')
         logging.info(f"{shipState['eng']['fTitle']} {shipState['eng']['name']} has written a personal log.")
     
@@ -198,29 +218,29 @@ def crewActions(shipState):
         if shipState['to_analyze_artifact'] > 0:
             toResearch.append('artifact')
         if len(toResearch) > 0:
-            thing = random.choice(toResearch)
+            thing = gen.choice(toResearch)
             if shipState['health_lab'] > 75:
-                shipState[f'lab_count_{thing}'] -= 1
+                shipState[f'lab_count_{thing}'] -= 1*ticks
             else:
-                shipState[f'lab_count_{thing}'] -= 0.5
-    if magicCoin("bidaily") and shipState['sci']['name'] != "VACANT":
+                shipState[f'lab_count_{thing}'] -= 0.5*ticks
+    if events.happened("log_sci") and shipState['sci']['name'] != "VACANT":
         writeOfficialLog(shipState, 'sci')
         logging.info(f"{shipState['sci']['fTitle']} {shipState['sci']['name']} has written a personal log.")
     return shipState
 
-def rewardResearch(shipState, thing):
+def rewardResearch(shipState, thing, gen=random):
     # If the lab has completed research, this function will process their
     # reward. Also resets research counters. Returns shipState.
     if thing == 'artifact':
-        reward = random.randrange(30000,50000)
+        reward = gen.randrange(30000,50000)
         shipState['money'] += reward
         shipState['to_analyze_artifact'] -= 1
         shipState['lab_count_artifact'] = shipState['lab_base']
         logging.info(f"LAB: Transmitted completed artifact research, received ${reward} reward!")
     else:  # thing == 'tech'
-        reward = random.randrange(5000,10000)
+        reward = gen.randrange(5000,10000)
         shipState['money'] += reward
-        component = random.choice([ 'max_spd',   'fuel_eff', 'lab_base',
+        component = gen.choice([ 'max_spd',   'fuel_eff', 'lab_base',
                                     'mod_radar', 'mod_sonar' ])
         
         if component == 'max_spd':
@@ -230,13 +250,13 @@ def rewardResearch(shipState, thing):
                 shipState['cargo_iron'] = 0
             msg = f"increased max speed by 1 knot!"
         if component in ['mod_radar', 'mod_sonar']:
-            shipState[component] += random.randrange(2,10)
+            shipState[component] += gen.randrange(2,10)
             shipState['cargo_silicon'] -= 10
             if shipState['cargo_silicon'] < 0:
                 shipState['cargo_silicon'] = 0
             msg = f"boosted {component[4:]}'s range to {shipState[component]}% above baseline!"
         if component == 'fuel_eff':
-            shipState['fuel_eff'] -= random.uniform(0,1)
+            shipState['fuel_eff'] -= gen.uniform(0,1)
             shipState['cargo_iron'] -= 10
             if shipState['cargo_iron'] < 0:
                 shipState['cargo_iron'] = 0
@@ -245,7 +265,7 @@ def rewardResearch(shipState, thing):
                 shipState['fuel_eff'] = 1
                 msg = f"attempted to improve fuel efficiency, but already at optimal."
         if component == 'lab_base':
-            ptsOff = round(shipState['lab_base']*random.uniform(0.01, 0.05))
+            ptsOff = round(shipState['lab_base']*gen.uniform(0.01, 0.05))
             shipState['lab_base'] -= ptsOff
             shipState['cargo_silicon'] -= 10
             if shipState['cargo_silicon'] < 0:
@@ -271,8 +291,18 @@ def makeSaveFile(filename):
         os.makedirs(f"{conf['savedir']}/{dir}", mode=0o660, exist_ok=True)
 
     shipState = cm.loadConfig(f"./etc/template.save")
-    print(f"\nNo ship currently on file!")
 
+    if args.headless:
+        # Nobody to ask, so the stand-ins name the ship and crew
+        logging.info("No ship currently on file, commissioning one.")
+        shipState['name'] = f"ESV {args.ship}"
+        for role in ['co', 'cheng', 'cso', 'eng', 'sci']:
+            shipState[role]['name'] = ai.getName(shipState[role]['fTitle'])
+        cm.writeConfig(shipState, filename)
+        logging.info("Created new save.")
+        return
+
+    print(f"\nNo ship currently on file!")
     sName = input("What is the vessel's name? ").title()
     shipState['name'] = f"ESV {sName}"
     print(f"\nCommissioned {conf['hull']} : the {shipState['name']}\n")
@@ -361,6 +391,12 @@ def updateShipState(shipState, t):
                     h -= crewHPS*t*2
             h  = 100 if h > 100 else h
             shipState[person]['health'] = h
+
+    # Record telemetry
+    crewH = [shipState[p]['health'] for p in crew if shipState[p]['name'] != "VACANT"]
+    crewH = sum(crewH)/len(crewH) if crewH else 0
+    dbs.recordTelemetry((d-1)*86400 + tS, newLoc[0], newLoc[1], speed, fuel,
+                        shipState['health_hull'], engineH, crewH)
     return shipState
 
 def getSimpleCoords(x,y):
@@ -392,10 +428,13 @@ def atPOI(shipState, contact):
     # Main event handler for when ship is at a POI. Takes in contact (tuple),
     # returns shipState. 
     shipState['spd'] = 0
-    random.seed(wg.makeGridSeed(shipState['shipX'], shipState['shipY']))
+    gen = rngs.getStream("poi-visit", shipState['shipX'], shipState['shipY'],
+                         shipState['day'], shipState['tStamp'],
+                         legacy=wg.makeGridSeed(shipState['shipX'], shipState['shipY']))
     images = []
+    finds  = []  # What the away team found, for exploreContent() to write up
     pProps = {}
-    size = random.randrange(1, 60)
+    size = gen.randrange(1, 60)
     picTypes = ["island", "derelict", "wreck", "coral", "underwater cave"]
     picLife = ["island", "wreck", "coral", "underwater cave"]
     display.updateDisplay(shipState, "Anchoring...")
@@ -408,19 +447,15 @@ def atPOI(shipState, contact):
         pProps['adj']       = POIdata[2]
         pProps['weirdness'] = POIdata[3]
         desc                = POIdata[4]
-        images = json.loads(POIdata[5])
+        images              = list(POIdata[5])
         logging.info(f"Arrived at {pProps['name']}")
     else:
         pProps = wg.getPOI(contact)
-        desc = ai.getPOIdescription(pProps, size)
+        desc = None  # Written along with the pictures, see exploreContent()
         logging.info(f"Discovered new {pProps['type']} and named it {pProps['name']}")
     dbs.deleteEID(shipState['trackID'])
     shipState['trackID'] = -1
-
-    ## Generate initial pictures
-    if pProps['type'] in picTypes:
-        tag = f"{shipState['day']}-{shipState['tStamp']}_{contact[0]}-{contact[1]}_{pProps['name']}"
-        images.append(ai.getImage(desc, tag))
+    tag = f"{shipState['day']}-{shipState['tStamp']}_{contact[0]}-{contact[1]}_{pProps['name']}"
     
     ## Deploy explorers and wait for explore time (if applicable)
     if pProps['type'] in picTypes:
@@ -434,15 +469,16 @@ def atPOI(shipState, contact):
                 break
         if canExplore(shipState, contact):
             logging.info(f"Deploying away team to explore {pProps['name']}")
-            random.seed(f"{conf['hull']}-{shipState['day']}-{shipState['tStamp']}")
+            gen = rngs.getStream("away-team", shipState['day'], shipState['tStamp'],
+                                 legacy=f"{conf['hull']}-{shipState['day']}-{shipState['tStamp']}")
             if pProps['type'] in ['island', 'derelict']:
                 boat = 'dinghy'
             else:
                 boat = 'sub'            
             display.updateDisplay(shipState, f"Away team deployed to {pProps['name']}")
             doze(size)
-            if random.randrange(0, 100) < 10:  # Chance of boat damage
-                damage = random.randrange(10, 100)
+            if gen.randrange(0, 100) < 10:  # Chance of boat damage
+                damage = gen.randrange(10, 100)
                 shipState[f"health_{boat}"] -= damage
                 logging.info(f"The {boat} took damage during the away mission! Health is at {shipState[f'health_{boat}']}")
                 if shipState[f"health_{boat}"] <= 0:
@@ -451,9 +487,9 @@ def atPOI(shipState, contact):
                         crewDeath(shipState, member)
                     logging.info(f"The {boat} was destroyed during the mission - all hands lost.")
                     writeOfficialLog(shipState, 'co', f"loss of the away team while exploring {pProps['name']}")
-            if random.randrange(0, 100) < 10: # Chance of personal injury
-                damage = random.randrange(10, 100)
-                pickCrew = awayTeam[random.randint(0,1)]
+            if gen.randrange(0, 100) < 10: # Chance of personal injury
+                damage = gen.randrange(10, 100)
+                pickCrew = awayTeam[gen.randint(0,1)]
                 shipState[pickCrew]['health'] = shipState[pickCrew]['health'] - damage
                 logging.info(f"{shipState[pickCrew]['name']} got injured during the away mission! Health is at {shipState[pickCrew]['health']}")
                 if shipState[pickCrew]['health'] <= 0:
@@ -468,40 +504,17 @@ def atPOI(shipState, contact):
 
             if shipState[f'health_{boat}'] >= 0:
                 if pProps['type'] in picLife:
-                    desc_fauna = ai.getObjectDescription("animal", pProps)
-                    tag = f"{shipState['day']}-{shipState['tStamp']}_{contact[0]}-{contact[1]}_{pProps['name']}_fauna"
-                    images.append(ai.getImage(desc_fauna,tag))
-                    sleep(5)
-                    desc_flora = ai.getObjectDescription("plant", pProps)
-                    tag = f"{shipState['day']}-{shipState['tStamp']}_{contact[0]}-{contact[1]}_{pProps['name']}_flora"
-                    images.append(ai.getImage(desc_flora,tag))
-                    title = f"Away Team Report on Life Discovered at {pProps['name']}"
-                    content = f"Excursion occurred on day {shipState['day']}.\n\n"
-                    content = f"{content}Flora Discovered:\n    "
-                    content = f"{content}{desc_flora}\n\nFauna Discovered:\n    {desc_fauna}"
-                    postText(title, content)
+                    finds.append("life")
                 if "tech" in pProps['resources']:
-                    desc_tech = ai.getObjectDescription("tech", pProps)
-                    tag = f"{shipState['day']}-{shipState['tStamp']}_{contact[0]}-{contact[1]}_{pProps['name']}_tech"
-                    images.append(ai.getImage(desc_tech,tag))
+                    finds.append("tech")
                     shipState['to_analyze_tech'] += 1
-                    title = f"{shipState['cso']['fTitle']}'s Report on Recovered Technology Discovered at {pProps['name']}"
-                    content = f"Excursion occurred on day {shipState['day']}.\n\n"
-                    content = f"{content}{desc_tech}"
-                    postText(title, content)
                 if "artifact" in pProps['resources']:
-                    desc_art = ai.getObjectDescription("artifact", pProps)
-                    tag = f"{shipState['day']}-{shipState['tStamp']}_{contact[0]}-{contact[1]}_{pProps['name']}_artifact"
-                    images.append(ai.getImage(desc_art,tag))
+                    finds.append("artifact")
                     shipState['to_analyze_artifact'] += 1
-                    title = f"{shipState['cso']['fTitle']}'s Report on Ancient Artifact Discovered at {pProps['name']}"
-                    content = f"Excursion occurred on day {shipState['day']}.\n\n"
-                    content = f"{content}{desc_art}"
-                    postText(title, content)
                 
                 for rsource in pProps['resources']:
                     cargo = f"cargo_{rsource}"
-                    bAmount = random.uniform(10,40)
+                    bAmount = gen.uniform(10,40)
                     if rsource in ['food', 'iron', 'silicon']:
                         amount = round(bAmount)
                     elif rsource in ['water', 'fuel']:
@@ -560,16 +573,73 @@ def atPOI(shipState, contact):
         shipState = buyStuff(shipState)
         writeOfficialLog(shipState, 'co', f"visiting and trading with the crew of {pProps['name']}")
 
-    ## Write to POI table and post images
+    ## Write to POI table, then have the write-ups and pictures done in the
+    ## background (see finishVisit())
     if pid is None:
-        dbs.writePOI(contact, pProps, desc, images)
-    else:
-        dbs.updatePOI(pid, images)
-    if images != []:
-        postImages(f"Photographs from {pProps['name']}", images)
+        pid = dbs.writePOI(contact, pProps, None, [])
+    picture = pProps['type'] in picTypes
+    visit   = { 'pid'    : pid,
+                'name'   : pProps['name'],
+                'day'    : shipState['day'],
+                'cso'    : shipState['cso']['fTitle'],
+                'desc'   : desc,
+                'images' : images }
+    ai.submit(partial(finishVisit, visit), exploreContent,
+              dict(pProps), size, desc, tag, picture, finds)
 
     return shipState
 
+def exploreContent(pProps, size, desc, tag, picture, finds):
+    # Generates the write-ups and pictures for a visit to a POI: its
+    # description (if <desc> is None), a picture of it (if <picture>) and a
+    # write-up and picture of each thing the away team found (<finds>). Runs
+    # on the AI engine's workers, so it mustn't touch the game state or DB.
+    # Returns a dictionary of the results.
+    content = { 'desc' : desc, 'images' : [], 'reports' : {} }
+    if desc is None:
+        content['desc'] = ai.getPOIdescription(pProps, size)
+    if picture:
+        content['images'].append(ai.getImage(content['desc'], tag))
+    if "life" in finds:
+        fauna = ai.getObjectDescription("animal", pProps)
+        content['images'].append(ai.getImage(fauna, f"{tag}_fauna"))
+        flora = ai.getObjectDescription("plant", pProps)
+        content['images'].append(ai.getImage(flora, f"{tag}_flora"))
+        content['reports']['life'] = (flora, fauna)
+    for thing in ["tech", "artifact"]:
+        if thing in finds:
+            text = ai.getObjectDescription(thing, pProps)
+            content['images'].append(ai.getImage(text, f"{tag}_{thing}"))
+            content['reports'][thing] = text
+    return content
+
+def finishVisit(visit, content):
+    # Attaches the results of exploreContent() to the POI's record and posts
+    # them. <visit> holds what's needed from the time of the visit. Returns no
+    # output.
+    if visit['desc'] is None:
+        dbs.describePOI(visit['pid'], content['desc'])
+    dbs.updatePOI(visit['pid'], content['images'])
+
+    excursion = f"Excursion occurred on day {visit['day']}.\n\n"
+    if "life" in content['reports']:
+        flora, fauna = content['reports']['life']
+        title = f"Away Team Report on Life Discovered at {visit['name']}"
+        text  = f"{excursion}Flora Discovered:\n    "
+        text  = f"{text}{flora}\n\nFauna Discovered:\n    {fauna}"
+        postText(title, text)
+    if "tech" in content['reports']:
+        title = f"{visit['cso']}'s Report on Recovered Technology Discovered at {visit['name']}"
+        postText(title, f"{excursion}{content['reports']['tech']}")
+    if "artifact" in content['reports']:
+        title = f"{visit['cso']}'s Report on Ancient Artifact Discovered at {visit['name']}"
+        postText(title, f"{excursion}{content['reports']['artifact']}")
+
+    images = visit['images'] + content['images']
+    if images != []:
+        postImages(f"Photographs from {visit['name']}", images)
+    return
+
 def buyStuff(shipState):
     # Buys resources when at a "shop" POI. Takes in and returns ShipState.
     resources = [ [ "fuel",  2, shipState['fuel_cap'] ],
@@ -617,22 +687,45 @@ def writeOfficialLog(shipState, role, event=""):
     tag = "EVENT" if event != "" else "PERSONAL"
     filename = f"{cTime}_{gTime}_{role.upper()}_{tag}.shiplog"
 
-    # Generate the log
+    # Generate the log in the background, see saveLog(). If this person's
+    # last personal log is still being generated, this one waits for it and
+    # carries on from it instead of the one on disk (see continueLog()).
     fTitle = shipState[role]['fTitle']
-    logtext = f"{fTitle}'s Log, Day {shipState['day']}, Time {shipState['tStamp']}\n\n"
+    header = f"{fTitle}'s Log, Day {shipState['day']}, Time {shipState['tStamp']}\n\n"
     footer = display.buildFooter(shipState) if event != "" else ""
-    gentext = ai.getPersonalLog(shipState[role]['name'], shipState['name'], fTitle, event, lastlogtext)
-    logtext = "" if gentext == "" else f"{logtext}{gentext}\n{footer}"
-
-    # Write the log to disk & post it online
-    if logtext != "":
-        with open(f"{path}/{filename}", "w") as file:
-            file.write(logtext)
-        if event != "":
-            title = f"{fTitle}'s Log: {event.title()}"
-        else:
-            title = f"{fTitle}'s Personal Log"
-        postText(title, logtext)
+    if event != "":
+        title = f"{fTitle}'s Log: {event.title()}"
+    else:
+        title = f"{fTitle}'s Personal Log"
+    prevJob = personalLogs.get(role) if event == "" else None
+    job = ai.submit(partial(saveLog, f"{path}/{filename}", title, header, footer),
+                    continueLog, prevJob, shipState[role]['name'],
+                    shipState['name'], fTitle, event, lastlogtext)
+    if event == "":
+        personalLogs[role] = job
+    return
+
+def continueLog(prevJob, name, ship, role, event, prevlog):
+    # Runs on an AI worker. Waits for <prevJob> (the Future of the previous
+    # personal log, or None) and uses its text as <prevlog> if it came out,
+    # so that logs written in quick succession still follow on from each
+    # other. Returns the text from ai.getPersonalLog().
+    if prevJob is not None:
+        try:
+            prevlog = prevJob.result() or prevlog
+        except Exception:
+            pass  # Carry on from the last log on disk instead
+    return ai.getPersonalLog(name, ship, role, event, prevlog)
+
+def saveLog(filename, title, header, footer, gentext):
+    # Writes a generated log (see writeOfficialLog()) to disk & posts it
+    # online, unless the generation came back empty. Returns no output.
+    if gentext == "":
+        return
+    logtext = f"{header}{gentext}\n{footer}"
+    with open(filename, "w") as file:
+        file.write(logtext)
+    postText(title, logtext)
     return
 
 def writeAutoLog(shipState, tag, descText):
@@ -734,12 +827,40 @@ def shipDeath(shipState):
     return
 
 def killSim(shipState):
-    # Gracefully shuts down the program.
-    savefile = f"./{conf['savedir']}/{conf['savename']}"
-    cm.writeConfig(shipState, savefile)
+    # Gracefully shuts down the program, once any logs and write-ups still
+    # being generated have been saved.
+    ai.collect(wait=True)
+    dbs.saveShipState(shipState)
+    if dbs.inWork():
+        dbs.endWork()
+    exportShipState(shipState)
+    if args.headless:
+        reportThroughput(shipState)
     quit()
     return
 
+def reportThroughput(shipState):
+    # Prints (and logs) how fast a headless run went, in simulated seconds
+    # per wall-clock second and ticks per second. Returns no output.
+    wall = perf_counter() - wallStart
+    sim  = (shipState['day']-1)*86400 + shipState['tStamp'] - simStart
+    rate = f"{tick} ticks, {sim/86400:.2f} days simulated in {wall:.1f}s: " \
+           f"{sim/wall:.0f} sim-s/s, {tick/wall:.1f} ticks/s"
+    logging.info(f"HEADLESS: {rate}")
+    print(rate)
+    return
+
+def exportShipState(shipState):
+    # Writes the ship state out to the JSON save file. The game itself runs
+    # off the copy in the database, so this is just for backups and for
+    # editing by hand - edits are only picked up when the game is started
+    # with --import-state. Writes to a temporary file first so a crash can't
+    # leave a half-written save behind. Returns no output.
+    savefile = f"./{conf['savedir']}/{conf['savename']}"
+    cm.writeConfig(shipState, f"{savefile}.tmp")
+    os.replace(f"{savefile}.tmp", savefile)
+    return
+
 def rotateCrew(shipState):
     # Maintains the ship's chain-of-command by promoting crew members
     # appropriately after a loss of crew. Takes in and returns shipState.
@@ -766,7 +887,9 @@ def rotateCrew(shipState):
 def isEvent(shipState):
     # Determine if a special event is happening during the tick and, if it is,
     # then handle it. Receives and returns shipState (dictionary).
-    random.seed(wg.makeGridSeed(shipState['shipX'], shipState['shipY']))
+    gen = rngs.getStream("events", shipState['shipX'], shipState['shipY'],
+                         shipState['day'], shipState['tStamp'],
+                         legacy=wg.makeGridSeed(shipState['shipX'], shipState['shipY']))
     eventHappened = False
 
     ## Determine If Ship Dead
@@ -785,24 +908,25 @@ def isEvent(shipState):
             atPOI(shipState, track)
             eventHappened = True
 
-    ## Random ship malfunction
-    if magicCoin('biweekly'):
-        component = random.choice(['engine', 'lab', 'bridge', 'dinghy', 'sub'])
+    ## Random ship malfunction. Each of these events happens as many times as
+    ## it came due, in case a long step covered more than one.
+    for _ in range(events.happened('malfunction')):
+        component = gen.choice(['engine', 'lab', 'bridge', 'dinghy', 'sub'])
         eventText = f"malfunction in the {component}"
-        damage = round(shipState[f'health_{component}']*random.randrange(75)/100)
+        damage = round(shipState[f'health_{component}']*gen.randrange(75)/100)
         shipState[f'health_{component}'] -= damage
         writeOfficialLog(shipState, 'cheng', eventText)
         logging.info(f"ENGINEERING: {component} has suffered a critical malfunction.")
         eventHappened = True
 
     ## Storm Event
-    if magicCoin('weekly'):
-        severe = 3 if magicCoin(10) else 1  # Set multiplier for if the storm
+    for _ in range(events.happened('storm')):
+        severe = 3 if magicCoin(10, gen) else 1  # Set multiplier for if the storm
                                             # is severe.
         components = ['hull', 'lab', 'bridge', 'dinghy', 'sub']
         for component in components:
             health = shipState[f'health_{component}']
-            damage = round(health*(random.randrange(25)/100)*severe)
+            damage = round(health*(gen.randrange(25)/100)*severe)
             shipState[f'health_{component}'] -= damage
         if severe == 3:
             eventText = "sustained severe damage after encountering a maelstrom"
@@ -813,27 +937,27 @@ def isEvent(shipState):
         eventHappened = True 
 
     ## Determine If Creature Attack
-    if magicCoin('monthly'):
+    for _ in range(events.happened('creature')):
         tPrompt = """ A horrific sea creature attacking a research vessel. The 
                       picture is from the perspective of a camera mounted on the
                       ship's bridge. """
-        images = [ ai.getImage(tPrompt, "creature-attack") ]
-        hulldamage = floor(shipState['health_hull']*random.randrange(75)/100)
+        title = f"Footage from the creature attack on day {shipState['day']}"
+        ai.submit(lambda image: postImages(title, [image]),
+                  ai.getImage, tPrompt, "creature-attack")
+        hulldamage = floor(shipState['health_hull']*gen.randrange(75)/100)
         shipState['health_hull'] -= hulldamage
-        component = random.choice(['engine', 'lab', 'bridge', 'dinghy', 'sub'])
-        cDamage = round(shipState[f'health_{component}']*random.randrange(50)/100)
+        component = gen.choice(['engine', 'lab', 'bridge', 'dinghy', 'sub'])
+        cDamage = round(shipState[f'health_{component}']*gen.randrange(50)/100)
         shipState[f'health_{component}'] -= cDamage
-        postImages(f"Footage from the creature attack on day {shipState['day']}", images)
-        sleep(5)
         eventText = "sustained damage when attacked by a large sea creature"
         writeOfficialLog(shipState, 'co', eventText)
         logging.info(f"LAB: Encountered a previously-unknown leviathan at sea.")
         eventHappened = True
     
     ## Determine If Random Illness
-    if magicCoin('monthly'):
-        role = random.choice(['co', 'cheng', 'cso', 'eng', 'sci'])
-        sickness = round(shipState[role]['health']*random.randrange(80)/100)
+    for _ in range(events.happened('illness')):
+        role = gen.choice(['co', 'cheng', 'cso', 'eng', 'sci'])
+        sickness = round(shipState[role]['health']*gen.randrange(80)/100)
         shipState[role]['health'] -= sickness
         eventText = f"illness of {shipState[role]['fTitle']} {shipState[role]['name']}."
         writeOfficialLog(shipState, 'cso', eventText)
@@ -867,7 +991,7 @@ def finishTick(shipState):
     shipState['spd'] = speed
 
     if pid is not None:
-        poiname = dbs.loadPOI(pid)[1]
+        poiname = dbs.poiName(pid)
         msg = f"Cruising towards {poiname}"
     else:
         if shipState['trackID'] == 1:
@@ -884,57 +1008,163 @@ def finishTick(shipState):
 # INITIALIZATION
 conf = cm.loadConfig(confFile)
 
+parser = argparse.ArgumentParser(description="Run Chip's Ocean Game.")
+parser.add_argument("--headless", action="store_true",
+                    help="run as fast as possible with no display, network or prompts")
+parser.add_argument("--standins", default="lib.standIns",
+                    help="module standing in for OpenAI and Reddit when headless (default: %(default)s)")
+parser.add_argument("--ship", default="Headless",
+                    help="name for a new ship when headless (default: %(default)s)")
+parser.add_argument("--import-state", action="store_true",
+                    help="load the ship state from the JSON save file, replacing the one in the database")
+parser.add_argument("--ticks", type=int, default=0,
+                    help="stop after this many ticks (default: run until stopped)")
+parser.add_argument("--days", type=int, default=0,
+                    help="stop after this many days on the ship's clock (default: run until stopped)")
+args = parser.parse_args()
+
+logHandlers = [ logging.FileHandler(conf['logfile'], mode='a') ]
+if not args.headless:
+    logHandlers.append(logging.StreamHandler())
 logging.basicConfig(
     level=conf['loglevel'],
     format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(conf['logfile'], mode='a'),
-        logging.StreamHandler()])
+    handlers=logHandlers)
 praw_logger = logging.getLogger('praw')
 praw_logger.setLevel(logging.CRITICAL)
 praw_logger.addHandler(logging.NullHandler())
 logging.info("INIT - Logger")
 
+napTime = 0  # Seconds headless runs have "slept" since the last tick
+personalLogs = {}  # Latest personal log job for each role (see writeOfficialLog())
+if args.headless:
+    # External calls go to the stand-ins, the display stays dark and nothing
+    # waits around. Time spent sleeping still passes on the ship's clock,
+    # though (see the main loop). The POI memo is kept in memory so the
+    # stand-ins' placeholder names never make it in to the real one.
+    standIns = importlib.import_module(args.standins)
+    ai = wg.ai = standIns
+    wg.openMemo(":memory:")
+    display.enabled = False
+    def sleep(secs):
+        global napTime
+        napTime += max(secs, 0)
+        return
+    logging.info(f"INIT - Headless, using {args.standins}")
+
 saveFileName = f"./{conf['savedir']}/{conf['savename']}"
 databaseName = f"./{conf['savedir']}/{conf['dbname']}"
-if not os.path.exists(saveFileName):
-    makeSaveFile(saveFileName)
-shipState = cm.loadConfig(saveFileName)
+os.makedirs(f"./{conf['savedir']}", exist_ok=True)
 dbs.initDBConnection(databaseName)
+shipState = None if args.import_state else dbs.loadShipState()
+if shipState is None:  # First run, a save from before the state moved in to
+                       # the DB, or the JSON save has been edited by hand
+    if not os.path.exists(saveFileName):
+        makeSaveFile(saveFileName)
+    shipState = dbs.importShipState(cm.loadConfig(saveFileName))
+    logging.info(f"Imported ship state from {saveFileName}")
 logging.info("INIT - Game State")
 
-reddit = praw.Reddit(
-    client_id     = conf["api_red_clientid"],
-    client_secret = conf["api_red_clientsecret"],
-    password      = conf["api_red_password"],
-    user_agent    = conf["api_red_useragent"],
-    username      = conf["api_red_username"])
-sub = reddit.subreddit(conf["subReddit"])
+if args.headless:
+    sub = standIns.Subreddit(conf["subReddit"])
+else:
+    import praw  # Only needed when actually posting, see --headless
+    reddit = praw.Reddit(
+        client_id     = conf["api_red_clientid"],
+        client_secret = conf["api_red_clientsecret"],
+        password      = conf["api_red_password"],
+        user_agent    = conf["api_red_useragent"],
+        username      = conf["api_red_username"])
+    sub = reddit.subreddit(conf["subReddit"])
 logging.info("INIT - Reddit API")
 
 timer = 0  # Initialize process timer
 tick  = 0  # Initialize tick counter
 
+# Where the run started, for the headless throughput report
+wallStart = perf_counter()
+simStart  = (shipState['day']-1)*86400 + shipState['tStamp']
+lastDay   = shipState['day'] + args.days
+
+# Each tick's DB writes are committed together. quikSail and headless ticks
+# fly by, so those get batched several ticks per commit.
+fastTicks   = shipState['quikSail'] or args.headless
+commitTicks = conf.get('commit_ticks_quiksail', 12) if fastTicks else 1
+
+# Real-time pacing (see sched.Clock). quikSail ticks come every half second
+# and each one covers a standard tick of game time, so it sails 10x as fast.
+if shipState['quikSail']:
+    clock = sched.Clock(0.5, conf.get('tick_catchup', "coalesce"),
+                        conf.get('tick_replay_max', 12), sched.TICK/0.5)
+else:
+    clock = sched.Clock(sched.TICK, conf.get('tick_catchup', "coalesce"),
+                        conf.get('tick_replay_max', 12))
+maxStep = conf.get('tick_max_step', 60)
+steps   = []  # Game seconds covered by each of the ticks about to run
+time_startLoop = perf_counter()
+
+# Random events, and how often each happens on average
+now    = sched.gameTime(shipState)
+events = sched.EventQueue(rngs.getStream("event-queue", conf['hull'], now))
+events.add('malfunction', "biweekly", now)
+events.add('storm',       "weekly",   now)
+events.add('creature',    "monthly",  now)
+events.add('illness',     "monthly",  now)
+for role in ['co', 'cheng', 'cso', 'eng', 'sci']:
+    events.add(f"log_{role}", "bidaily", now)
+
 # MAIN LOOP - THE BIG ENCHILADA!
 while True:
+    if not steps:
+        # Work out how much game time the next tick covers, unless missed
+        # ticks are still being replayed. Time the last tick spent held up
+        # (exploring, retrying posts...) is added on however the rest of the
+        # step is decided: what the crew "slept" in a headless run, or the
+        # real time it took otherwise. The clock counts real time by itself.
+        if args.headless:
+            napped = round(napTime)
+        else:
+            napped = round(perf_counter() - time_startLoop)
+        napTime = 0
+        if shipState.get('timeSkip', False):
+            # Jump straight to the next moment something can change. Skipped
+            # time isn't waited out.
+            ranges = [nav.computeEffectiveRange(shipState[f"range_{s}"], shipState[f"mod_{s}"])
+                      for s in ['radar', 'sonar']]
+            steps  = [sched.nextStep(shipState, ranges,
+                                     events.nextDue() - sched.gameTime(shipState)) + napped]
+        elif args.headless:
+            steps = [sched.TICK + napped]
+        else:
+            steps = clock.wait()
     time_startLoop = perf_counter()
+    timer = steps.pop(0)
     tick += 1
-    shipState = updateShipState(shipState, timer)
+    if not dbs.inWork():
+        dbs.beginWork()
+    dbs.newTick()
+    ai.collect()  # Save whatever logs and write-ups have finished generating
+    ticks = timer/sched.TICK  # How many standard ticks this one stands for
+    for step in sched.subSteps(timer, maxStep):
+        shipState = updateShipState(shipState, step)
+    events.advance(sched.gameTime(shipState))
     sensorSweep(shipState)
-    shipState = crewActions(shipState)
+    shipState = crewActions(shipState, ticks)
     shipState = isEvent(shipState)
     shipState = finishTick(shipState)
-    if tick % 12 == 0:  # Save ShipState to disk every 12 ticks (~1 per minute)
-        cm.writeConfig(shipState, saveFileName)
+    dbs.saveShipState(shipState)  # Only writes the fields that changed
+    if tick % commitTicks == 0:
+        dbs.endWork()
     # Back up the save file roughly every 12 hours
-    if tick % 8640 == 0 and not shipState['quikSail']:
+    if tick % 8640 == 0 and not fastTicks:
+        exportShipState(shipState)
+        dbs.checkpoint()
         os.system("./backupSave.sh")
         logging.info("Backed up save file.")
-    time_stopLoop = perf_counter() - time_startLoop
-    if time_stopLoop < 5:
-        if shipState['quikSail']:
-            sleep(0.5-time_stopLoop)
-        else:
-            sleep(5-time_stopLoop)
-    timer = round(perf_counter() - time_startLoop)
-
+    if tick % 8640 == 0:
+        logging.debug(f"Contact tile cache: {wg.getCacheStats()}")
+        logging.debug(f"DB read cache: {dbs.getReadStats()}")
+        dbs.verifyCounts()
+    if args.headless and ((args.ticks and tick >= args.ticks) or
+                          (args.days and shipState['day'] >= lastDay)):
+        killSim(shipState)
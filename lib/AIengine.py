@@ -2,7 +2,9 @@
 
 ## CHIP'S OCEAN GAME (COG) AI ENGINE
 ##
-## Functions related to interfacing with OpenAI
+## Functions related to interfacing with OpenAI. The slow calls can be run on
+## a pool of worker threads with submit(), so the game doesn't stop while it
+## waits on them.
 
 
 # IMPORTS AND CONSTANTS
@@ -11,6 +13,7 @@ import re
 import logging
 from datetime import datetime
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
 
 from lib.configManager import loadConfig
 
@@ -167,6 +170,38 @@ def getImage(tprompt, tag):
     
     return filename
 
+def submit(onDone, func, *args):
+    # Starts func(*args) (one of the functions above, or anything built from
+    # them) on the worker pool. Once it's finished, the next collect() hands
+    # the result to onDone(result) on the thread that called collect(), so
+    # onDone can safely touch the game state and the DB. Returns the job's
+    # Future.
+    future = pool.submit(func, *args)
+    pending.append((future, onDone))
+    return future
+
+def collect(wait=False):
+    # Hands the results of finished jobs to their onDone callbacks, in the
+    # order the jobs were submitted. With <wait>, blocks until every job is
+    # done, including any that the callbacks submit. Returns the number of
+    # jobs collected.
+    count = 0
+    while pending:
+        ready = [job for job in pending if wait or job[0].done()]
+        if not ready:
+            break
+        for job in ready:
+            pending.remove(job)
+            future, onDone = job
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.info(f"Content generation job failed: {e}")
+                continue
+            onDone(result)
+            count += 1
+    return count
+
 def getPersonalLog(name, ship, role="", event="", prevlog=""):
     tPrompt = ""
 
@@ -210,6 +245,10 @@ openai_logger.setLevel(logging.CRITICAL)
 #openai_logger.addHandler(logging.FileHandler(conf['logfile'], mode='a'))
 openai_logger.addHandler(logging.NullHandler())
 
+pool    = ThreadPoolExecutor(max_workers=conf.get('ai_workers', 2),
+                             thread_name_prefix="AIengine")
+pending = []  # Submitted jobs as (Future, onDone) tuples
+
 # UNIT TESTS
 if __name__ == "__main__":
     # Test getImage()
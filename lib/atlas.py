@@ -0,0 +1,142 @@
+#!/bin/python3
+
+## CHIP'S OCEAN GAME (COG) ATLAS MODULE
+##
+## Reads and writes world atlas files - pregenerated contact fields that can
+## be queried straight off the disk instead of being generated on the fly.
+## Atlas files are produced by atlasgen.py.
+##
+## FILE LAYOUT (all values little-endian):
+##   Header - fixed size, see HEADER below.
+##   Index  - one INDEX entry per tile, ordered by sensor code, then tile Y,
+##            then tile X, covering every tile in the region (so an entry's
+##            position can be computed rather than searched for).
+##   Data   - int32 values. Each tile is its contacts' Y coordinates (sorted)
+##            followed by their matching X coordinates.
+
+
+## IMPORTS AND CONSTANTS
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+
+MAGIC  = b"COGATLS1"
+HEADER = struct.Struct("<8sQiidd6i4x")  # magic, hull key, mode, tile size,
+                                        # surface & sub chances, region (tile
+                                        # x1,y1,x2,y2), sensor bitmask, count
+INDEX  = struct.Struct("<ii")           # data offset (in int32s), count
+MODES  = { "compat" : 0, "fast" : 1 }
+
+
+## FUNCTIONS
+def sensorCodes(mask):
+    # Unpacks the header's sensor bitmask in to a sorted list of sensor codes.
+    return [code for code in range(32) if mask & (1 << code)]
+
+def writeAtlas(filename, meta, tiles):
+    # Writes an atlas file. Takes the filename, a dictionary of metadata (keys
+    # matching the HEADER fields: hullKey, mode, tileSize, chanceU, chanceL,
+    # region, sensors) and a dictionary of tiles keyed by (sensor code, tx, ty)
+    # holding lists of (x,y) contacts. Every tile in the region must be
+    # present, even if it's empty. Returns no output.
+    tx1, ty1, tx2, ty2 = meta['region']
+    mask = 0
+    for code in meta['sensors']:
+        mask |= 1 << code
+    index = bytearray()
+    data  = array('i')
+    count = 0
+    for code in sensorCodes(mask):
+        for ty in range(ty1, ty2+1):
+            for tx in range(tx1, tx2+1):
+                contacts = sorted(tiles[(code, tx, ty)], key=lambda c: (c[1], c[0]))
+                index += INDEX.pack(len(data), len(contacts))
+                data.extend(c[1] for c in contacts)
+                data.extend(c[0] for c in contacts)
+                count += 1
+    if sys.byteorder != "little":
+        data.byteswap()
+
+    header = HEADER.pack(MAGIC, meta['hullKey'], MODES[meta['mode']],
+                         meta['tileSize'], meta['chanceU'], meta['chanceL'],
+                         tx1, ty1, tx2, ty2, mask, count)
+    with open(filename, "wb") as f:
+        f.write(header)
+        f.write(index)
+        f.write(data.tobytes())
+    return
+
+def openAtlas(filename, hullKey, mode, tileSize, chanceU, chanceL):
+    # Memory-maps an atlas file so that it's available for queries. The world
+    # settings are passed in so that an atlas generated for a different hull,
+    # engine or set of probabilities gets rejected. Returns True if the atlas
+    # was opened, False if it doesn't match this world. Raises ValueError if
+    # the file is cut short or its index points outside the data.
+    global atlas
+    closeAtlas()
+    with open(filename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mm) < HEADER.size:
+        mm.close()
+        return False
+    fields = HEADER.unpack_from(mm, 0)
+    if fields[:6] != (MAGIC, hullKey, MODES[mode], tileSize, chanceU, chanceL) \
+       or sys.byteorder != "little":
+        mm.close()
+        return False
+
+    tx1, ty1, tx2, ty2, mask, count = fields[6:]
+    codes     = sensorCodes(mask)
+    dataStart = HEADER.size + INDEX.size*count
+    words     = (len(mm) - dataStart)//4  # Whole int32s in the data section
+    if count < 0 or count != len(codes)*(tx2-tx1+1)*(ty2-ty1+1) or \
+       dataStart > len(mm) or \
+       any(offset < 0 or n < 0 or offset + 2*n > words
+           for offset, n in INDEX.iter_unpack(mm[HEADER.size:dataStart])):
+        mm.close()
+        raise ValueError("atlas is truncated or its index is corrupt")
+    atlas = { "mm"      : mm,
+              "region"  : (tx1, ty1, tx2, ty2),
+              "codes"   : codes,
+              "data"    : memoryview(mm)[dataStart:dataStart+4*words].cast('i') }
+    return True
+
+def closeAtlas():
+    # Releases the currently open atlas (if there is one).
+    global atlas
+    if atlas is not None:
+        atlas['data'].release()
+        atlas['mm'].close()
+        atlas = None
+    return
+
+def hasTile(code, tx, ty):
+    # Checks whether the open atlas covers tile (tx,ty) for the given sensor
+    # code. Returns True or False.
+    if atlas is None or code not in atlas['codes']:
+        return False
+    tx1, ty1, tx2, ty2 = atlas['region']
+    return tx1 <= tx <= tx2 and ty1 <= ty <= ty2
+
+def queryTile(code, tx, ty, box):
+    # Finds the contacts from tile (tx,ty) that fall inside a search box
+    # ([x1,y1, x2,y2] as given by worldgen.findBounds). Uses a binary search
+    # on the tile's sorted Y coordinates so only the matching rows are read.
+    # Returns a list of (x,y) tuples. Assumes hasTile() has been checked.
+    tx1, ty1, tx2, ty2 = atlas['region']
+    ntx = tx2 - tx1 + 1
+    nty = ty2 - ty1 + 1
+    pos = (atlas['codes'].index(code)*nty + (ty-ty1))*ntx + (tx-tx1)
+    offset, count = INDEX.unpack_from(atlas['mm'], HEADER.size + INDEX.size*pos)
+
+    ys = atlas['data'][offset:offset+count]
+    xs = atlas['data'][offset+count:offset+2*count]
+    lo = bisect_right(ys, box[3])
+    hi = bisect_right(ys, box[1])
+    return [(xs[i], ys[i]) for i in range(lo, hi) if box[0] <= xs[i] < box[2]]
+
+
+## INITIALIZATION
+atlas = None  # The currently open atlas, if any
@@ -9,10 +9,125 @@
 import sqlite3
 import json
 import os
+import logging
+import zlib
+from array import array
+from itertools import groupby
+from math import ceil, log, sqrt
+from hashlib import blake2b
 
 from lib.configManager import loadConfig
 
 conffile = "./etc/main.conf"
+MIGRATIONBATCH = 10000  # Rows per step when a migration rewrites a table
+TELEMETRYTIERS = [ ("tick", 0), ("minute", 60), ("hour", 3600) ]  # Name and
+                                         # bucket width (game seconds) per tier
+
+
+# CLASSES
+class BloomFilter:
+    # Fixed-size probabilistic set of grid locations. Never forgets anything
+    # that was added, but may report a location as present when it isn't (at
+    # roughly the false-positive rate it was sized for). Items can't be removed.
+    def __init__(self, capacity, fpRate):
+        self.size   = max(8, ceil(-capacity*log(fpRate) / log(2)**2))
+        self.hashes = max(1, round(self.size/capacity * log(2)))
+        self.bits   = bytearray(ceil(self.size/8))
+
+    def positions(self, loc):
+        # Bit positions for a location, by double hashing one blake2b digest.
+        digest = blake2b(f"{loc[0]},{loc[1]}".encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i*h2) % self.size for i in range(self.hashes)]
+
+    def add(self, loc):
+        for pos in self.positions(loc):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def discard(self, loc):
+        pass  # Bloom filters can't forget - stale entries are just positives
+
+    def __contains__(self, loc):
+        for pos in self.positions(loc):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+class POIGroup:
+    # Every explored POI of a single type, stored column-wise in compact
+    # arrays. Iterating yields (pid, (X,Y,surf/sub)) tuples in PID order, the
+    # same shape dumpType() has always returned.
+    def __init__(self, cType):
+        self.cType = cType
+        self.pids  = array('q')
+        self.xs    = array('q')
+        self.ys    = array('q')
+
+    def append(self, pid, x, y):
+        self.pids.append(pid)
+        self.xs.append(x)
+        self.ys.append(y)
+
+    def ranges(self, loc):
+        # Yields (range, pid, X, Y) for every POI in the group, without
+        # building a list.
+        for pid, x, y in zip(self.pids, self.xs, self.ys):
+            yield (sqrt((x-loc[0])**2 + (y-loc[1])**2), pid, x, y)
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __iter__(self):
+        for pid, x, y in zip(self.pids, self.xs, self.ys):
+            yield (pid, (x, y, self.cType))
+
+class ShipState(dict):
+    # The ship state dictionary, along with a record of which top-level keys
+    # have changed since it was last saved (see saveShipState()). Nested
+    # dictionaries such as the crew records are wrapped in StateSections, so
+    # changing one of their fields marks the parent key as dirty.
+    def __init__(self, state=()):
+        super().__init__()
+        self.dirty = set()
+        self.update(state)
+
+    def __setitem__(self, key, value):
+        if isinstance(value, dict):
+            value = StateSection(self, key, value)
+        super().__setitem__(key, value)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.dirty.add(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+class StateSection(dict):
+    # A dictionary nested inside a ShipState. Any change marks <key> in the
+    # parent ShipState as dirty.
+    def __init__(self, parent, key, values):
+        super().__init__()
+        self.parent = parent
+        self.key    = key
+        self.update(values)
+
+    def __setitem__(self, key, value):
+        if isinstance(value, dict):
+            value = StateSection(self.parent, self.key, value)
+        super().__setitem__(key, value)
+        self.parent.dirty.add(self.key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.parent.dirty.add(self.key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
 
 
 # FUNCTIONS
@@ -34,8 +149,6 @@ def makeDB(filename):
                   name TEXT,
                   adj TEXT,
                   weird INTEGER,
-                  desc TEXT,
-                  images TEXT,
                   items TEXT); """
     tab_toexplore = """ CREATE TABLE TO_EXPLORE (
                         eid INTEGER PRIMARY KEY,
@@ -49,17 +162,208 @@ def makeDB(filename):
     
     cursor.execute(tab_poi)
     cursor.execute(tab_toexplore)
+    cursor.execute(idx_poi)
+    cursor.execute(idx_toexplore)
+    for statement in spatial + poiStorage + shipStorage + telemetryStorage:
+        cursor.execute(statement)
     cursor.execute(homeport)
     cursor.execute(boldlygo)
+    cursor.execute(f"PRAGMA user_version = {len(migrations)};")
     cursor.close()
     db.commit()
     db.close()
     return
 
+def upgradeDB():
+    # Brings a database created by an older version of COG up to date by
+    # running every migration newer than its PRAGMA user_version, in order.
+    # Each migration runs in its own transaction along with the version bump,
+    # so an interrupted upgrade picks up where it left off next time. Safe to
+    # run on a database that's already up to date.
+    cursor = db.cursor()
+    version = cursor.execute("PRAGMA user_version;").fetchone()[0]
+    for number, (name, migration) in enumerate(migrations[version:], start=version+1):
+        logging.info(f"Migrating database to version {number}: {name}")
+        cursor.execute("BEGIN;")
+        try:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number};")
+            db.commit()
+        except:
+            db.rollback()
+            raise
+    cursor.close()
+    return
+
+def keyBatches(cursor, table, key, label):
+    # Splits <table> in to ranges of its integer primary key <key>, so that
+    # migrations touching every row can work through a big table a piece at a
+    # time and report their progress. Yields (low, high) bounds, high
+    # exclusive.
+    top = cursor.execute(f"SELECT MAX({key}) FROM {table};").fetchone()[0] or 0
+    for lo in range(0, top+1, MIGRATIONBATCH):
+        yield lo, lo+MIGRATIONBATCH
+        if top >= MIGRATIONBATCH:
+            logging.info(f"    {label}: {min(lo+MIGRATIONBATCH-1, top)} of {top}")
+    return
+
+def tableExists(cursor, name):
+    # Checks the schema for a table called <name>. Returns True or False.
+    command = "SELECT 1 FROM sqlite_master WHERE type == 'table' AND name == ?;"
+    return cursor.execute(command, (name,)).fetchone() is not None
+
+def migrateLocIndexes(cursor):
+    # Version 1: unique location indexes on POI and TO_EXPLORE. Any duplicate
+    # TO_EXPLORE records (which the index wouldn't allow) are removed first,
+    # keeping the oldest copy.
+    cursor.execute(""" DELETE FROM TO_EXPLORE WHERE eid NOT IN (
+                       SELECT MIN(eid) FROM TO_EXPLORE
+                       GROUP BY locX, locY, type); """)
+    cursor.execute(idx_toexplore)
+    try:
+        cursor.execute(idx_poi)
+    except sqlite3.IntegrityError:
+        # Explored POIs aren't ours to throw away, so fall back to a plain
+        # index if an old save somehow has two at the same spot.
+        logging.warning("Duplicate POI locations found - using a non-unique index")
+        cursor.execute(idx_poi.replace("UNIQUE ", ""))
+    return
+
+def migrateSpatial(cursor):
+    # Version 2: R*Tree tables mirroring POI and TO_EXPLORE locations, kept in
+    # sync by triggers.
+    populate = not tableExists(cursor, "POI_RTREE")
+    for statement in spatial:
+        cursor.execute(statement)
+    if not populate:
+        return
+    for lo, hi in keyBatches(cursor, "POI", "pid", "POI locations"):
+        cursor.execute(""" INSERT INTO POI_RTREE
+                           SELECT pid, locX, locX, locY, locY FROM POI
+                           WHERE pid >= ? AND pid < ?; """, (lo, hi,))
+    for lo, hi in keyBatches(cursor, "TO_EXPLORE", "eid", "TO_EXPLORE locations"):
+        cursor.execute(""" INSERT INTO TO_EXPLORE_RTREE
+                           SELECT eid, locX, locX, locY, locY FROM TO_EXPLORE
+                           WHERE eid >= ? AND eid < ?; """, (lo, hi,))
+    return
+
+def migratePOIStorage(cursor):
+    # Version 3: POI descriptions (compressed) and image lists move out of the
+    # POI table in to POI_TEXT and POI_IMAGES. The old columns are left empty.
+    for statement in poiStorage:
+        cursor.execute(statement)
+    if "desc" not in [row[1] for row in cursor.execute("PRAGMA table_info(POI);")]:
+        return
+    for lo, hi in keyBatches(cursor, "POI", "pid", "POI descriptions and images"):
+        cursor.execute(""" SELECT pid, desc, images FROM POI
+                           WHERE pid >= ? AND pid < ?
+                             AND (desc IS NOT NULL OR images IS NOT NULL); """, (lo, hi,))
+        for pid, desc, images in cursor.fetchall():
+            if desc is not None:
+                cursor.execute("INSERT OR REPLACE INTO POI_TEXT (pid, desc) VALUES (?, ?);",
+                               (pid, packText(desc)))
+            if images is not None:
+                cursor.executemany("INSERT INTO POI_IMAGES (pid, image) VALUES (?, ?);",
+                                   [(pid, image) for image in json.loads(images)])
+        cursor.execute(""" UPDATE POI SET desc = NULL, images = NULL
+                           WHERE pid >= ? AND pid < ?; """, (lo, hi,))
+    return
+
+def migrateShipState(cursor):
+    # Version 4: the SHIP_STATE key/value table. It starts out empty and gets
+    # filled from the JSON save file the first time COG runs, see
+    # importShipState().
+    for statement in shipStorage:
+        cursor.execute(statement)
+    return
+
+def migrateTelemetry(cursor):
+    # Version 5: the TELEMETRY table.
+    for statement in telemetryStorage:
+        cursor.execute(statement)
+    return
+
+def autoCommit():
+    # Commits the writes made so far - unless a unit of work is open, in which
+    # case they'll be committed together when it ends. Every write function
+    # calls this instead of committing on its own.
+    if workDepth == 0:
+        db.commit()
+    return
+
+def beginWork():
+    # Opens a unit of work (or nests inside the one already open). Writes made
+    # until the matching endWork() all go in to a single transaction, so they
+    # cost one commit between them.
+    global workDepth
+    workDepth += 1
+    return
+
+def endWork():
+    # Closes a unit of work opened by beginWork(). When the outermost one
+    # closes, everything written during it is committed.
+    global workDepth
+    workDepth = max(0, workDepth-1)
+    if workDepth == 0:
+        db.commit()
+    return
+
+def abortWork():
+    # Throws away everything written during the open unit of work and closes
+    # it (along with any nested ones). The known-location set, counters and
+    # POI directory are rebuilt since they may have picked up rows that were
+    # never committed.
+    global workDepth
+    workDepth = 0
+    db.rollback()
+    warmKnownLocs()
+    loadCounts()
+    poiDirectory.clear()
+    flushReads()
+    return
+
+def inWork():
+    # Returns True if a unit of work is currently open.
+    return workDepth > 0
+
+def checkpoint():
+    # Folds the write-ahead log back in to the main database file, e.g. so
+    # that a backup of the save directory is self-contained.
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    return
+
+def flushReads():
+    # Empties the read cache. Called by every function that writes to the
+    # database, since any cached row could be out of date afterwards.
+    readCache.clear()
+    return
+
+def newTick():
+    # Marks a tick boundary: the read cache is emptied so nothing carries over
+    # between ticks, and the number of queries it saved during the tick that
+    # just ended is added to the running totals. Returns that number.
+    saved = readStats['saved']
+    readStats['lastTick'] = saved
+    readStats['total']   += saved
+    readStats['ticks']   += 1
+    readStats['saved']    = 0
+    flushReads()
+    return saved
+
+def getReadStats():
+    # Reports how many queries the read cache has saved. Returns a dictionary
+    # with the count for the last full tick, the running total, the number of
+    # ticks seen and the count so far for the current tick.
+    return dict(readStats)
+
 def lookupContact(eid):
     # Looks up a contact from the to_explore table by its EID number. Takes in
     # the database object and requested EID as input, returns the contact as a
-    # tuple.
+    # tuple. Repeat lookups within a tick are served from the read cache.
+    key = ("contact", eid)
+    if key in readCache:
+        readStats['saved'] += 1
+        return readCache[key]
     cursor = db.cursor()
     command = "SELECT locX, locY, type FROM TO_EXPLORE WHERE eid == ?"
     cursor.execute(command, (eid,))
@@ -69,6 +373,7 @@ def lookupContact(eid):
         contact = (result[0],result[1],result[2])
     except:
         contact = None
+    readCache[key] = contact
     return contact
 
 def lookupEID(loc):
@@ -88,6 +393,10 @@ def lookupEID(loc):
 def lookupPID(loc):
     # Looks up the EID for a contact located at <loc> (tuple) from the
     # to_explore table. Takes db object and location, returns EID as int.
+    key = ("pid", loc[0], loc[1])
+    if key in readCache:
+        readStats['saved'] += 1
+        return readCache[key]
     cursor = db.cursor()
     command = "SELECT pid FROM POI WHERE locX == ? AND locY == ?;"
     cursor.execute(command, (loc[0], loc[1],))
@@ -96,40 +405,184 @@ def lookupPID(loc):
     except:
         result = None
     cursor.close()
+    readCache[key] = result
     return result
 
 def deleteEID(eid):
     # Deletes a record from the to_explore table, identified by EID.
+    contact = lookupContact(eid)
     cursor = db.cursor()
     command = "DELETE FROM TO_EXPLORE WHERE eid == ?;"
     cursor.execute(command, (eid,))
-    db.commit()
+    if cursor.rowcount > 0:
+        tallyContacts(contact[2], -1)
+    flushReads()
+    autoCommit()
     cursor.close()
+    if contact is not None:  # Only forget the location if nothing else is there
+        loc = (contact[0], contact[1])
+        if lookupEID(loc) is None and lookupPID(loc) is None:
+            knownLocs.discard(loc)
     return
 
 def countTableEntries(table):
-    # Count how many entries are in a table. Returns an int.
+    # Count how many entries are in a table, not counting the record every
+    # table starts with (home port / "Boldly Go"). Answered from the in-memory
+    # counters for POI and TO_EXPLORE. Returns an int.
+    if table in tableCounts:
+        return tableCounts[table]-1
     cursor = db.cursor()
-    command = f"SELECT * FROM {table};"
-    cursor.execute(command)
-    result = cursor.fetchall()
-    return len(result)-1
+    cursor.execute(f"SELECT COUNT(*) FROM {table};")
+    result = cursor.fetchone()[0]
+    cursor.close()
+    return result-1
+
+def countType(type):
+    # Returns how many POIs of <type> have been explored, as an int.
+    return typeCounts.get(type, 0)
+
+def countClass(cType, table="TO_EXPLORE"):
+    # Returns how many surface ("U") or submerged ("L") records <table> (POI
+    # or TO_EXPLORE) holds, as an int.
+    return classCounts[table].get(cType, 0)
+
+def poiClass(type):
+    # Maps a POI type to "U" (surface) or "L" (submerged). Returns None for
+    # types that are neither, such as the home port.
+    if type in types['surface_pois']:
+        return "U"
+    if type in types['submerged_pois']:
+        return "L"
+    return None
+
+def tally(counts, key, delta):
+    # Adds <delta> to counts[key], dropping the key once it gets back to zero
+    # so the counters look just like queryCounts() (which never has zeroes).
+    counts[key] = counts.get(key, 0) + delta
+    if counts[key] == 0:
+        del counts[key]
+    return
+
+def tallyContacts(cType, delta):
+    # Adjusts the TO_EXPLORE counters after rows of class <cType> were added
+    # (positive delta) or removed (negative delta).
+    tableCounts['TO_EXPLORE'] += delta
+    tally(classCounts['TO_EXPLORE'], cType, delta)
+    return
+
+def tallyPOI(type, delta):
+    # Same as tallyContacts(), but for POI rows of a given POI type.
+    tableCounts['POI'] += delta
+    tally(typeCounts, type, delta)
+    cType = poiClass(type)
+    if cType is not None:
+        tally(classCounts['POI'], cType, delta)
+    return
+
+def queryCounts():
+    # Counts POI and TO_EXPLORE straight from the database. Returns a tuple of
+    # (table totals, POI type counts, class counts) dictionaries.
+    tables  = { "POI" : 0, "TO_EXPLORE" : 0 }
+    pTypes  = {}
+    classes = { "POI" : {}, "TO_EXPLORE" : {} }
+    cursor = db.cursor()
+    cursor.execute("SELECT type, COUNT(*) FROM TO_EXPLORE GROUP BY type;")
+    for cType, n in cursor.fetchall():
+        tables['TO_EXPLORE'] += n
+        classes['TO_EXPLORE'][cType] = n
+    cursor.execute("SELECT type, COUNT(*) FROM POI GROUP BY type;")
+    for pType, n in cursor.fetchall():
+        tables['POI'] += n
+        pTypes[pType] = n
+        cType = poiClass(pType)
+        if cType is not None:
+            classes['POI'][cType] = classes['POI'].get(cType, 0) + n
+    cursor.close()
+    return tables, pTypes, classes
+
+def loadCounts():
+    # Initializes the in-memory counters from the database. Returns no output.
+    global tableCounts, typeCounts, classCounts
+    tableCounts, typeCounts, classCounts = queryCounts()
+    return
+
+def verifyCounts():
+    # Checks the in-memory counters against COUNT(*) queries, resetting them if
+    # they've drifted. Returns True if they were accurate, False if not.
+    actual = queryCounts()
+    if actual == (tableCounts, typeCounts, classCounts):
+        return True
+    logging.warning("Table counters had drifted from the database - resetting them.")
+    loadCounts()
+    return False
 
 def loadPOI(pid):
     # Loads already-discovered POI data from the database. Takes in the DB
-    # connection and requested PID as input, returns list containing the 
-    # associated POI record.
+    # connection and requested PID as input, returns a tuple of (type, name,
+    # adjective, weirdness, description, list of images), or None if there's
+    # no such POI. Hot paths that only need a field or two should use
+    # poiName() or poiSummary() instead.
+    key = ("poi", pid)
+    if key in readCache:
+        readStats['saved'] += 1
+        return readCache[key]
+    summary = poiSummary(pid)
+    result = None if summary is None else summary + (poiDescription(pid), poiImages(pid))
+    readCache[key] = result
+    return result
+
+def poiSummary(pid):
+    # Loads just the small columns of a POI record. Returns a tuple of (type,
+    # name, adjective, weirdness), or None if there's no such POI.
+    key = ("summary", pid)
+    if key in readCache:
+        readStats['saved'] += 1
+        return readCache[key]
     cursor = db.cursor()
-    command = """ SELECT type, name, adj, weird, desc, images 
-                  FROM POI WHERE pid == ?; """
+    command = "SELECT type, name, adj, weird FROM POI WHERE pid == ?;"
     cursor.execute(command, (pid,))
     result = cursor.fetchone()
     cursor.close()
+    readCache[key] = result
     return result
 
+def poiName(pid):
+    # Returns the name of a POI as a string, or None if there's no such POI.
+    summary = poiSummary(pid)
+    return None if summary is None else summary[1]
+
+def poiDescription(pid):
+    # Loads and decompresses a POI's description from POI_TEXT. Returns it as
+    # a string, or None if the POI doesn't have one.
+    cursor = db.cursor()
+    cursor.execute("SELECT desc FROM POI_TEXT WHERE pid == ?;", (pid,))
+    result = cursor.fetchone()
+    cursor.close()
+    return None if result is None else unpackText(result[0])
+
+def poiImages(pid):
+    # Returns the list of image files taken at a POI, oldest first.
+    cursor = db.cursor()
+    command = "SELECT image FROM POI_IMAGES WHERE pid == ? ORDER BY iid;"
+    cursor.execute(command, (pid,))
+    result = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return result
+
+def packText(text):
+    # Compresses a string for storage in a BLOB column. Returns bytes, or
+    # None if <text> is None.
+    return None if text is None else zlib.compress(text.encode("utf-8"), 9)
+
+def unpackText(blob):
+    # Reverses packText(). Returns a string, or None if <blob> is None.
+    return None if blob is None else zlib.decompress(blob).decode("utf-8")
+
 def writePOI(contact, pProps, desc, images):
     # Creates a new record in the POI table. Takes in location and pProp data
-    # as well as a list of captured images, returns nothing as output. 
+    # as well as a list of captured images, returns the new record's pid. The
+    # description and images go in POI_TEXT and POI_IMAGES. <desc> can be
+    # None if it's still being written (see describePOI()).
     cursor = db.cursor()
 
     locX  = contact[0]
@@ -138,39 +591,187 @@ def writePOI(contact, pProps, desc, images):
     name  = pProps['name']
     adj   = pProps['adj']
     weird = pProps['weirdness']
-    imags = json.dumps(images)
 
-    command = """ INSERT INTO POI (locX, locY, type, name, adj, weird, desc, images) 
-                  VALUES (?, ?, ?, ?, ?, ?, ?, ?); """
+    command = """ INSERT INTO POI (locX, locY, type, name, adj, weird) 
+                  VALUES (?, ?, ?, ?, ?, ?); """
     
-    cursor.execute(command, (locX, locY, type, name, adj, weird, desc, imags,))
-    db.commit()
+    cursor.execute(command, (locX, locY, type, name, adj, weird,))
+    pid = cursor.lastrowid
+    if desc is not None:
+        cursor.execute("INSERT INTO POI_TEXT (pid, desc) VALUES (?, ?);",
+                       (pid, packText(desc),))
+    cursor.executemany("INSERT INTO POI_IMAGES (pid, image) VALUES (?, ?);",
+                       [(pid, image) for image in images])
+    tallyPOI(type, 1)
+    poiDirectory.pop(type, None)
+    flushReads()
+    autoCommit()
     cursor.close()
-    return
+    knownLocs.add((locX, locY))
+    return pid
 
 def writeContacts(contacts):
     # Writes a list of contacts to the TO_EXPLORE table. Contacts are taken as
-    # a list of tuples (X coord, Y coord, Surface/Submerge). Returns no output.
+    # a list of tuples (X coord, Y coord, Surface/Submerge). Contacts that are
+    # already queued are skipped. Returns no output.
     cursor = db.cursor()
-    command = """ INSERT INTO TO_EXPLORE (locX, locY, type)
+    command = """ INSERT OR IGNORE INTO TO_EXPLORE (locX, locY, type)
                   VALUES (?, ?, ?); """
     
+    insertByClass(cursor, command, [tuple(c[:3]) for c in contacts])
     for contact in contacts:
-        cursor.execute(command, contact)
+        knownLocs.add((contact[0], contact[1]))
     
-    db.commit()
+    flushReads()
+    autoCommit()
+    cursor.close()
+    return
+
+def ingestContacts(contacts):
+    # Records the results of a sensor sweep. Takes a list of contacts (X, Y,
+    # Surface/Submerged) and adds the ones whose location isn't already in
+    # TO_EXPLORE or POI, all in a single statement. Returns the number of new
+    # contacts added.
+    unique = {}
+    for contact in contacts:
+        unique.setdefault((contact[0], contact[1]), tuple(contact[:3]))
+    if len(unique) == 0:
+        return 0
+
+    cursor = db.cursor()
+    command = """ INSERT OR IGNORE INTO TO_EXPLORE (locX, locY, type)
+                  SELECT ?1, ?2, ?3
+                  WHERE NOT EXISTS (SELECT 1 FROM TO_EXPLORE
+                                    WHERE locX == ?1 AND locY == ?2)
+                    AND NOT EXISTS (SELECT 1 FROM POI
+                                    WHERE locX == ?1 AND locY == ?2); """
+    added = insertByClass(cursor, command, list(unique.values()))
+    if added > 0:
+        flushReads()
+    autoCommit()
+    cursor.close()
+    for loc in unique:
+        knownLocs.add(loc)
+    return added
+
+def insertByClass(cursor, command, rows):
+    # Runs a TO_EXPLORE insert statement over a list of (X, Y, class) rows,
+    # one executemany per run of same-class rows (keeping the rows in order) so
+    # the counters know what was actually added. Returns the total number of
+    # rows inserted.
+    added = 0
+    for cType, run in groupby(rows, key=lambda row: row[2]):
+        cursor.executemany(command, list(run))
+        tallyContacts(cType, cursor.rowcount)
+        added += cursor.rowcount
+    return added
+
+def queryBox(loc, r, types=None, table="POI"):
+    # Pulls every record of <table> (POI or TO_EXPLORE) inside the square of
+    # half-width <r> around <loc> from its R*Tree, optionally limited to a
+    # list of POI types (or contact classes, for TO_EXPLORE). The "Boldly Go"
+    # record is never returned. Returns a list of (id, (X,Y,surf/sub), range)
+    # tuples sorted by range, then id.
+    key = "pid" if table == "POI" else "eid"
+    command = f""" SELECT t.{key}, t.locX, t.locY, t.type
+                   FROM {table}_RTREE r JOIN {table} t ON t.{key} == r.id
+                   WHERE r.maxX >= ? AND r.minX <= ?
+                     AND r.maxY >= ? AND r.minY <= ? AND t.type != 'B'"""
+    params = [loc[0]-r, loc[0]+r, loc[1]-r, loc[1]+r]
+    if types is not None:
+        command += f" AND t.type IN ({','.join('?'*len(types))})"
+        params += list(types)
+    cursor = db.cursor()
+    cursor.execute(command + ";", params)
+    results = cursor.fetchall()
+    cursor.close()
+    contacts = []
+    for result in results:
+        cType = poiClass(result[3]) or "L" if table == "POI" else result[3]
+        rng = sqrt((result[1]-loc[0])**2 + (result[2]-loc[1])**2)
+        contacts.append((result[0], (result[1], result[2], cType), rng))
+    contacts.sort(key=lambda c: (c[2], c[0]))
+    return contacts
+
+def withinRadius(loc, r, types=None, table="POI"):
+    # Finds every record of <table> within range <r> of <loc>, optionally
+    # limited to a list of POI types (or contact classes, for TO_EXPLORE).
+    # Returns a list of (id, (X,Y,surf/sub), range) tuples, closest first.
+    return [c for c in queryBox(loc, r, types, table) if c[2] <= r]
+
+def nearest(loc, types=None, k=1, table="POI"):
+    # Finds the <k> records of <table> closest to <loc>, optionally limited to
+    # a list of POI types (or contact classes, for TO_EXPLORE). Searches an
+    # ever-growing box around <loc> until it either holds <k> records inside
+    # the search radius or every matching record in the table. Returns a list
+    # of up to <k> (id, (X,Y,surf/sub), range) tuples, closest first.
+    if types is None:
+        counts = tableCounts[table]
+    elif table == "POI":
+        counts = sum(typeCounts.get(t, 0) for t in dict.fromkeys(types))
+    else:
+        counts = sum(classCounts['TO_EXPLORE'].get(t, 0) for t in dict.fromkeys(types))
+    if table == "TO_EXPLORE" and (types is None or 'B' in types):
+        counts -= 1  # Never returned, see queryBox()
+    if counts <= 0 or k <= 0:
+        return []
+    r = 32
+    while True:
+        contacts = queryBox(loc, r, types, table)
+        inRange = [c for c in contacts if c[2] <= r]
+        if len(inRange) >= k or len(contacts) >= counts or r > 2**32:
+            return contacts[:k]
+        r *= 2
+
+def isKnown(loc):
+    # Checks the in-memory set of known locations (anything queued in
+    # TO_EXPLORE or already explored in POI) without touching the database.
+    # Takes a location (X, Y, ...) and returns True or False. In "bloom" mode
+    # a small fraction of new locations will wrongly come back True.
+    return (loc[0], loc[1]) in knownLocs
+
+def warmKnownLocs():
+    # (Re)builds the in-memory set of known locations from the database, as
+    # either an exact set or a Bloom filter depending on the 'knownset'
+    # config value. The "Boldly Go" record isn't a real contact, so it's left
+    # out. Returns no output.
+    global knownLocs
+    if conf.get('knownset', "exact") == "bloom":
+        knownLocs = BloomFilter(conf.get('bloom_capacity', 1000000),
+                                conf.get('bloom_fprate', 0.001))
+    else:
+        knownLocs = set()
+    cursor = db.cursor()
+    cursor.execute(""" SELECT locX, locY FROM TO_EXPLORE WHERE type != 'B'
+                       UNION SELECT locX, locY FROM POI; """)
+    for row in cursor:
+        knownLocs.add(row)
     cursor.close()
     return
 
 def updatePOI(pid, images):
     # Updates an existing POI record with new images. Takes the list of image
-    # files as input as well as the pid of the relevant record. Returns no
+    # files as input as well as the pid of the relevant record. Only images
+    # that aren't already on file are appended to POI_IMAGES. Returns no
     # output.
     cursor = db.cursor()
-    imags = json.dumps(images)
-    command = """ UPDATE POI SET images = ? WHERE pid == ?; """
-    cursor.execute(command, (imags, pid,))
-    db.commit()
+    onFile = set(poiImages(pid))
+    command = """ INSERT INTO POI_IMAGES (pid, image) VALUES (?, ?); """
+    newImages = [image for image in dict.fromkeys(images) if image not in onFile]
+    cursor.executemany(command, [(pid, image) for image in newImages])
+    flushReads()
+    autoCommit()
+    cursor.close()
+    return
+
+def describePOI(pid, desc):
+    # Sets (or replaces) the description of an existing POI record. Returns
+    # no output.
+    cursor = db.cursor()
+    command = """ INSERT OR REPLACE INTO POI_TEXT (pid, desc) VALUES (?, ?); """
+    cursor.execute(command, (pid, packText(desc),))
+    flushReads()
+    autoCommit()
     cursor.close()
     return
 
@@ -180,10 +781,91 @@ def updateBold(loc):
     cursor = db.cursor()
     command = """ UPDATE TO_EXPLORE SET locX = ?, locY = ? WHERE eid == 1; """ 
     cursor.execute(command, (loc[0], loc[1],))
-    db.commit()
+    flushReads()
+    autoCommit()
     cursor.close()
     return 
 
+def loadShipState():
+    # Loads the ship state from the SHIP_STATE table, in the order the fields
+    # were first written. Returns a ShipState with no dirty fields, or None if
+    # the table is empty (i.e. the state hasn't been imported yet).
+    cursor = db.cursor()
+    cursor.execute("SELECT key, value FROM SHIP_STATE ORDER BY rowid;")
+    results = cursor.fetchall()
+    cursor.close()
+    if len(results) == 0:
+        return None
+    state = ShipState((key, json.loads(value)) for key, value in results)
+    state.dirty.clear()
+    return state
+
+def saveShipState(state):
+    # Writes the fields of a ShipState that changed since it was last saved
+    # to the SHIP_STATE table, as part of the open unit of work if there is
+    # one. Returns the number of fields written.
+    changed = [(key, json.dumps(value)) for key, value in state.items() if key in state.dirty]
+    removed = [(key,) for key in state.dirty if key not in state]
+    cursor = db.cursor()
+    command = """ INSERT INTO SHIP_STATE (key, value) VALUES (?, ?)
+                  ON CONFLICT (key) DO UPDATE SET value = excluded.value; """
+    cursor.executemany(command, changed)
+    cursor.executemany("DELETE FROM SHIP_STATE WHERE key == ?;", removed)
+    autoCommit()
+    cursor.close()
+    state.dirty.clear()
+    return len(changed) + len(removed)
+
+def importShipState(config):
+    # Takes a plain ship state dictionary (e.g. as loaded from the JSON save
+    # file), replaces whatever is in SHIP_STATE with it and returns it as a
+    # ShipState.
+    cursor = db.cursor()
+    cursor.execute("DELETE FROM SHIP_STATE;")
+    cursor.close()
+    state = ShipState(config)
+    saveShipState(state)
+    return state
+
+def recordTelemetry(t, x, y, spd, fuel, hull, engine, crew):
+    # Records a per-tick telemetry sample at game time <t> (seconds since the
+    # start of day 1). When a sample lands in a new minute or hour, the one
+    # that just finished is averaged in to a single row of the next tier up,
+    # and anything older than the 'telemetry_days' retention for its tier is
+    # pruned. The first sample after a restart works out which bucket the last
+    # run was in from the rows on file, so a minute or hour left unfinished
+    # when the game stopped still gets rolled up. Returns no output.
+    cursor = db.cursor()
+    command = """ INSERT OR REPLACE INTO TELEMETRY
+                  VALUES (0, ?, ?, ?, ?, ?, ?, ?, ?); """
+    cursor.execute(command, (t, x, y, spd, fuel, hull, engine, crew,))
+    rolled = False
+    for tier in range(1, len(TELEMETRYTIERS)):
+        width  = TELEMETRYTIERS[tier][1]
+        bucket = t // width
+        last   = telemetryBuckets.get(tier)
+        if last is None:
+            command = "SELECT MAX(t) FROM TELEMETRY WHERE tier == ? AND t < ?;"
+            cursor.execute(command, (tier-1, bucket*width,))
+            prev = cursor.fetchone()[0]
+            last = None if prev is None else prev // width
+        if last is not None and bucket > last:
+            command = """ INSERT OR REPLACE INTO TELEMETRY
+                          SELECT ?, ?, AVG(x), AVG(y), AVG(spd), AVG(fuel),
+                                 AVG(hull), AVG(engine), AVG(crew)
+                          FROM TELEMETRY WHERE tier == ? AND t >= ? AND t < ?
+                          HAVING COUNT(*) > 0; """
+            cursor.execute(command, (tier, last*width, tier-1, last*width, (last+1)*width,))
+            rolled = True
+        telemetryBuckets[tier] = bucket
+    if rolled:
+        keep = conf.get('telemetry_days', [1, 30, 730])
+        cursor.executemany("DELETE FROM TELEMETRY WHERE tier == ? AND t < ?;",
+                           [(tier, t - days*86400) for tier, days in enumerate(keep)])
+    autoCommit()
+    cursor.close()
+    return
+
 def initDBConnection(filename):
     # Kicks off a connection to the database so that it's available for other
     # function calls. If the DB file doesn't exist yet, it will call makeDB()
@@ -193,6 +875,15 @@ def initDBConnection(filename):
     if not os.path.exists(filename):
         makeDB(filename)
     db = sqlite3.connect(filename)
+    sync = str(conf.get('db_synchronous', "NORMAL")).upper()
+    if sync not in ["OFF", "NORMAL", "FULL", "EXTRA"]:
+        logging.warning(f"Unknown db_synchronous setting {sync}, using NORMAL")
+        sync = "NORMAL"
+    db.execute("PRAGMA journal_mode=WAL;")
+    db.execute(f"PRAGMA synchronous={sync};")
+    upgradeDB()
+    warmKnownLocs()
+    loadCounts()
     return
 
 def dumpAllContacts():
@@ -227,19 +918,88 @@ def dumpType(type):
     # Returns the locations of all explored POIs of <type>. Returns the
     # contacts along with their associated pids as a list of tuples in the form
     # of (pid, (X,Y,surf/sub)).
-    contacts = []
-    cursor = db.cursor()
-    command = "SELECT pid, locX, locY, type FROM POI WHERE type = ?;"
-    cursor.execute(command, (type,))
-    results = cursor.fetchall()
-    cursor.close()
-    for result in results:
-        cType = "U" if result[3] in types['surface_pois'] else "L"
-        contacts.append((result[0], (result[1], result[2], cType)))
-    return contacts
+    return list(poiGroup(type))
+
+def poiGroup(type):
+    # Returns the POI directory's POIGroup for <type>, loading it from the
+    # database the first time it's asked for (or the first time after a new
+    # POI of that type was written). Callers can iterate the group directly
+    # instead of asking for a fresh list each tick.
+    if type not in poiDirectory:
+        group = POIGroup(poiClass(type) or "L")
+        cursor = db.cursor()
+        command = "SELECT pid, locX, locY FROM POI WHERE type = ? ORDER BY pid;"
+        for row in cursor.execute(command, (type,)):
+            group.append(*row)
+        cursor.close()
+        poiDirectory[type] = group
+    return poiDirectory[type]
 
 
 # INITIALIZATION
+knownLocs = set()  # Locations in TO_EXPLORE or POI, see warmKnownLocs()
+workDepth = 0      # How many units of work are open, see beginWork()
+tableCounts = {}   # Row counters, see loadCounts()
+typeCounts  = {}
+classCounts = {}
+poiDirectory = {}  # POIGroups by type, see poiGroup()
+readCache = {}     # Rows read this tick, see newTick()
+readStats = { "saved" : 0, "lastTick" : 0, "total" : 0, "ticks" : 0 }
+telemetryBuckets = {}  # Current minute/hour bucket, see recordTelemetry()
+idx_poi       = """ CREATE UNIQUE INDEX IF NOT EXISTS idx_poi_loc
+                    ON POI (locX, locY); """
+idx_toexplore = """ CREATE UNIQUE INDEX IF NOT EXISTS idx_toexplore_loc
+                    ON TO_EXPLORE (locX, locY, type); """
+spatial       = [ """ CREATE VIRTUAL TABLE IF NOT EXISTS POI_RTREE
+                      USING rtree(id, minX, maxX, minY, maxY); """,
+                  """ CREATE VIRTUAL TABLE IF NOT EXISTS TO_EXPLORE_RTREE
+                      USING rtree(id, minX, maxX, minY, maxY); """,
+                  """ CREATE TRIGGER IF NOT EXISTS poi_rtree_ins AFTER INSERT ON POI
+                      BEGIN INSERT INTO POI_RTREE
+                            VALUES (new.pid, new.locX, new.locX, new.locY, new.locY); END; """,
+                  """ CREATE TRIGGER IF NOT EXISTS poi_rtree_upd AFTER UPDATE OF locX, locY ON POI
+                      BEGIN UPDATE POI_RTREE
+                            SET minX = new.locX, maxX = new.locX, minY = new.locY, maxY = new.locY
+                            WHERE id == new.pid; END; """,
+                  """ CREATE TRIGGER IF NOT EXISTS poi_rtree_del AFTER DELETE ON POI
+                      BEGIN DELETE FROM POI_RTREE WHERE id == old.pid; END; """,
+                  """ CREATE TRIGGER IF NOT EXISTS toexplore_rtree_ins AFTER INSERT ON TO_EXPLORE
+                      BEGIN INSERT INTO TO_EXPLORE_RTREE
+                            VALUES (new.eid, new.locX, new.locX, new.locY, new.locY); END; """,
+                  """ CREATE TRIGGER IF NOT EXISTS toexplore_rtree_upd AFTER UPDATE OF locX, locY ON TO_EXPLORE
+                      BEGIN UPDATE TO_EXPLORE_RTREE
+                            SET minX = new.locX, maxX = new.locX, minY = new.locY, maxY = new.locY
+                            WHERE id == new.eid; END; """,
+                  """ CREATE TRIGGER IF NOT EXISTS toexplore_rtree_del AFTER DELETE ON TO_EXPLORE
+                      BEGIN DELETE FROM TO_EXPLORE_RTREE WHERE id == old.eid; END; """ ]
+poiStorage    = [ """ CREATE TABLE IF NOT EXISTS POI_TEXT (
+                          pid INTEGER PRIMARY KEY,
+                          desc BLOB); """,
+                  """ CREATE TABLE IF NOT EXISTS POI_IMAGES (
+                          iid INTEGER PRIMARY KEY,
+                          pid INTEGER,
+                          image TEXT); """,
+                  """ CREATE INDEX IF NOT EXISTS idx_poiimages_pid
+                          ON POI_IMAGES (pid); """ ]
+shipStorage   = [ """ CREATE TABLE IF NOT EXISTS SHIP_STATE (
+                          key TEXT PRIMARY KEY,
+                          value TEXT); """ ]
+telemetryStorage = [ """ CREATE TABLE IF NOT EXISTS TELEMETRY (
+                             tier INTEGER,
+                             t REAL,
+                             x REAL,
+                             y REAL,
+                             spd REAL,
+                             fuel REAL,
+                             hull REAL,
+                             engine REAL,
+                             crew REAL,
+                             PRIMARY KEY (tier, t)) WITHOUT ROWID; """ ]
+migrations    = [ ("unique location indexes",   migrateLocIndexes),  # Applied in
+                  ("R*Tree spatial index",      migrateSpatial),     # order, see
+                  ("POI text and image tables", migratePOIStorage),  # upgradeDB()
+                  ("ship state table",          migrateShipState),
+                  ("telemetry table",           migrateTelemetry) ]
 conf = loadConfig(conffile)
 types = loadConfig(f"./{conf['typefile']}")
 
@@ -266,9 +1026,33 @@ if __name__ == "__main__":
     writeContacts(contacts)
     print(f"TEST 3: writeContacts() - Wrote {len(contacts)} contacts to TO_EXPLORE\n")
 
+    # Test 3b: Ingesting a sensor sweep
+    sweep = [ [19, 88, "U"], [19, 88, "L"], [50, 50, "L"], [50, 50, "U"], [-7, 3, "U"] ]
+    added = ingestContacts(sweep)
+    print(f"TEST 3b: ingestContacts() - Added {added} of {len(sweep)} swept contacts, expected 2\n")
+    deleteEID(lookupEID((50, 50)))
+    deleteEID(lookupEID((-7, 3)))
+    print(f"TEST 3c: isKnown() - (19, 88) is {isKnown((19, 88))}, expected True; (-7, 3) is {isKnown((-7, 3))}, expected False\n")
+
+    # Test 3d: Units of work
+    beginWork()
+    writeContacts([(600, 600, "U")])
+    writeContacts([(601, 601, "L")])
+    pending = db.in_transaction
+    endWork()
+    print(f"TEST 3d: beginWork() - Open until the end: {pending}, expected True; committed: {not db.in_transaction}, expected True")
+    beginWork()
+    writeContacts([(602, 602, "U")])
+    abortWork()
+    print(f"         abortWork() - Rolled back: {lookupEID((602, 602)) is None}, expected True\n")
+    for loc in [(600, 600), (601, 601)]:
+        deleteEID(lookupEID(loc))
+
     # Test 4: Counting how many records in TO_EXPLORE
     numContacts = countTableEntries("TO_EXPLORE")
-    print(f"TEST 4: countTableEntries() - Found {numContacts} contacts in the database out of {len(contacts)} expected\n")
+    print(f"TEST 4: countTableEntries() - Found {numContacts} contacts in the database out of {len(contacts)} expected")
+    print(f"        countClass() - {countClass('U')} surface, {countClass('L')} submerged, expected 2 and 3")
+    print(f"        verifyCounts() - Counters match the database: {verifyCounts()}, expected True\n")
 
     # Test 5: Finding the exploration identifier (EID) of a contact at a given
     #         location
@@ -324,7 +1108,7 @@ if __name__ == "__main__":
     # Test 9: Loading POI data from the table
     pid = 2
     poiData = loadPOI(pid)
-    images = json.loads(poiData[5])
+    images = poiData[5]
     print(f"Test 9: loadPOI() - Loading data for PID#{pid}")
     print(f"        Type:        {poiData[0]}")
     print(f"        Name:        {poiData[1]}")
@@ -343,8 +1127,10 @@ if __name__ == "__main__":
     pid = 3
     updatePOI(pid, images)
     poiData = loadPOI(pid)
-    limages = json.loads(poiData[5])
-    print(f"Test 11: updatePOI() - Added {limages[3]} to POI#{pid}, expected 'success.png'\n")
+    limages = poiData[5]
+    print(f"Test 11: updatePOI() - Added {limages[3]} to POI#{pid}, expected 'success.png'")
+    print(f"         Now has {len(limages)} images, expected 4")
+    print(f"         poiName() - POI#{pid} is {poiName(pid)}, expected Echo Wreck\n")
 
     # Test 12: Dumping all surface contacts
     print(f"Test 13: dumpSurfaceContacts() - Detected-but-unexplored contacts:")
@@ -383,3 +1169,51 @@ if __name__ == "__main__":
     contact = lookupContact(1)
     print(f"EID #1 is now {contact}, expect (3, 8, 'B')\n")
 
+
+    # Test 16: Spatial queries
+    fuel = nearest((300, 150), ['offshore platform', 'deposit'])
+    print(f"Test 16: nearest() - Closest fuel source to (300, 150) is {fuel}, expected PID 5")
+    near = withinRadius((10, 10), 10, ['U', 'L'], table="TO_EXPLORE")
+    print(f"         withinRadius() - Contacts within 10 of (10, 10): {[c[0] for c in near]}, expected [3, 5]")
+    print(f"         nearest() - {len(nearest((0, 0), k=100))} of {countTableEntries('POI')+1} POIs found when asking for 100, expected all")
+    deposits = nearest((0, 0), ['deposit'], k=100)
+    print(f"         nearest() - {len(deposits)} of {countType('deposit')} deposits found by type, expected all")
+
+    # Test 17: Tick-scoped read cache
+    newTick()
+    for i in range(3):
+        lookupContact(4)
+        loadPOI(lookupPID((103, -28)))
+    updateBold((5, 5))
+    bold = lookupContact(1)
+    print(f"Test 17: newTick() - Saved {newTick()} queries in a tick, expected 6")
+    print(f"         flushReads() - EID #1 after an update is {bold}, expected (5, 5, 'B')")
+
+    # Test 18: Ship state
+    importShipState({ "name" : "ESV Test", "spd" : 0, "co" : { "name" : "Kirk", "health" : 100 } })
+    state = loadShipState()
+    state['spd'] = 10
+    state['co']['health'] = 90
+    print(f"Test 18: saveShipState() - Wrote {saveShipState(state)} dirty fields, expected 2")
+    print(f"         loadShipState() - Reloaded {dict(loadShipState())}")
+    print(f"         expected {{'name': 'ESV Test', 'spd': 10, 'co': {{'name': 'Kirk', 'health': 90}}}}")
+
+    # Test 19: Telemetry
+    conf['telemetry_days'] = [1/24, 30, 730]
+    for t in range(0, 3*3600+5, 5):
+        recordTelemetry(t, t/100, 0, 10, 1000-t/100, 100, 100, 100)
+    tiers = "SELECT t, x FROM TELEMETRY WHERE tier == ? ORDER BY t;"
+    ticks = db.execute(tiers, (0,)).fetchall()
+    minutes = db.execute(tiers, (1,)).fetchall()
+    hours = db.execute(tiers, (2,)).fetchall()
+    print(f"Test 19: recordTelemetry() - Kept {len(ticks)} ticks, {len(minutes)} minutes and {len(hours)} hours, expected 721, 180 and 3")
+    print(f"         recordTelemetry() - First hour averaged X of {hours[0][1]}, expected 17.975")
+    telemetryBuckets.clear()  # As if the game had been restarted
+    recordTelemetry(4*3600, 0, 0, 10, 900, 100, 100, 100)
+    hours = db.execute(tiers, (2,)).fetchall()
+    print(f"         recordTelemetry() - Kept {len(hours)} hours after a restart, expected 4")
+
+    # Test 20: Counters after a class empties out
+    for eid, contact, rng in withinRadius((0, 0), 10**6, ['L'], table="TO_EXPLORE"):
+        deleteEID(eid)
+    print(f"Test 20: verifyCounts() - {verifyCounts()} after deleting every 'L' contact, expected True")
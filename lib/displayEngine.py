@@ -22,7 +22,10 @@ DIV   = '━'*WIDTH
 ## FUNCTIONS
 def updateDisplay(shipState, statusMsg):
     # Updates the status display sent to the console. Takes in the state of the
-    # ship as well as a free-hand status message.
+    # ship as well as a free-hand status message. Does nothing if the display
+    # is turned off (see 'enabled').
+    if not enabled:
+        return
     contact = dbs.lookupContact(shipState['trackID'])
     os.system('clear')
     print("")
@@ -244,7 +247,8 @@ def lpad(text, length, pad=' '):
 
 
 ## INITIALIZATION
-conf = loadConfig(CFILE)
+conf    = loadConfig(CFILE)
+enabled = True  # Headless runs turn the console display off
 
 if __name__ == "__main__":
     dbs.initDBConnection("./testdb.db")
@@ -8,6 +8,8 @@
 # IMPORTS AND CONSTANTS
 import math
 
+import numpy as np
+
 from lib.configManager import loadConfig
 
 confFile = "./etc/main.conf"
@@ -85,20 +87,55 @@ def convertETA(eta):
 
 def getClosest(origin, contacts, farthest=False):
     # When given an origin point and a list of contacts, returns the contact
-    # that's closest to the origin. Expects contacts as a list of tuple of 
-    # tuples in the form of (id#, (X,Y,type)). Returns (id#, (X,Y,type), range)
-    wRanges = []
+    # that's closest to the origin. Expects contacts as any iterable of tuple
+    # of tuples in the form of (id#, (X,Y,type)), such as a dbServices
+    # POIGroup. Returns (id#, (X,Y,type), range), or None if there are no
+    # contacts.
+    closest = None
     for contact in contacts:
         rng = computeRange(origin, contact[1])
-        wRanges.append((contact[0], contact[1], rng))
-    if not farthest:
-        closest = min(wRanges, key=lambda x:x[2])
-    # If "farthest" flag is set, then this function will actually return the
-    # farthest away contact instead of the closest.
-    else:
-        closest = max(wRanges, key=lambda x:x[2])
+        # If "farthest" flag is set, then this function will actually return
+        # the farthest away contact instead of the closest.
+        if closest is None or (rng > closest[2] if farthest else rng < closest[2]):
+            closest = (contact[0], contact[1], rng)
     return closest
 
+def contactArrays(contacts):
+    # Splits contacts in the usual (id#, (X,Y,type)) form in to an array of
+    # IDs and an (N,2) array of X,Y coordinates, ready for the array-based
+    # functions below. Returns both arrays as a tuple.
+    contacts = list(contacts)
+    ids    = np.fromiter((c[0] for c in contacts), dtype=np.int64, count=len(contacts))
+    coords = np.array([(c[1][0], c[1][1]) for c in contacts], dtype=float).reshape(-1, 2)
+    return ids, coords
+
+def computeRanges(ship, coords):
+    # Array version of computeRange(). Takes the ship's coordinates and an
+    # (N,2) array of contact coordinates, returns an array of N ranges.
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    xSub = coords[:,0] - ship[0]
+    ySub = coords[:,1] - ship[1]
+    return np.sqrt(xSub*xSub + ySub*ySub)
+
+def computeBearings(ship, coords):
+    # Array version of computeBearing(). Takes the ship's coordinates and an
+    # (N,2) array of contact coordinates, returns an array of N bearings
+    # (0 to 360, clockwise from North). atan2 covers the contacts directly
+    # above/below the ship, so no special cases are needed.
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    xSub = coords[:,0] - ship[0]
+    ySub = coords[:,1] - ship[1]
+    return np.degrees(np.arctan2(xSub, ySub)) % 360
+
+def computeETAs(speed, distances):
+    # Array version of computeETA(). Takes speed in knots and an array of
+    # distances, returns an array of ETAs in minutes. A stopped ship gets an
+    # ETA of infinity rather than an error, or 0 for anything it's already at.
+    distances = np.asarray(distances, dtype=float)
+    if speed <= 0:
+        return np.where(distances > 0, np.inf, 0.0)
+    return distances / (speed/60)
+
 
 # INITIALIZATION
 conf = loadConfig(confFile)
@@ -144,3 +181,15 @@ if __name__ == "__main__":
                  (4, (8,9,"L")) ]
     print("EXPECT:  (3, (6, 7, 'U'), 0.5000000000000001)")
     print(f"GOT:     {getClosest(shipLoc, contacts)}")
+    print("EXPECT:  None")
+    print(f"GOT:     {getClosest(shipLoc, [])}")
+
+    print("\nTesting array functions")
+    ids, coords = contactArrays(contacts)
+    print("EXPECT:  ranges match computeRange(), bearings match computeBearing()")
+    ranges   = computeRanges(shipLoc, coords)
+    bearings = computeBearings(shipLoc, coords)
+    print(f"GOT:     {all(ranges[i] == computeRange(shipLoc, c[1]) for i, c in enumerate(contacts))}, "
+          f"{all(abs(bearings[i] - computeBearing(shipLoc, c[1])) < 1e-9 for i, c in enumerate(contacts))}")
+    print("EXPECT:  ETAs [60.] and [inf  0.]")
+    print(f"GOT:     ETAs {computeETAs(10, [10])} and {computeETAs(0, [10, 0])}")
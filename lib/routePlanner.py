@@ -0,0 +1,247 @@
+#!/bin/python3
+
+## CHIP'S OCEAN GAME (COG) ROUTE PLANNER
+##
+## Orders the unexplored contacts around the ship in to a short tour instead
+## of letting the captain pick them at random, and works refuel/resupply stops
+## at known offshore platforms in to it. Enabled with the 'routeplan' config
+## value.
+
+
+## IMPORTS AND CONSTANTS
+import numpy as np
+
+import lib.navigation as nav
+import lib.dbServices as dbs
+
+PLANRADIUS = 480   # Only contacts this close to the ship get planned (nm)
+PLANSIZE   = 100   # Most contacts to keep in the tour at once
+MAXPASSES  = 20    # Improvement passes per rebuild
+FOODCAP    = 2250  # Rations on board after a platform visit, see cog.buyStuff()
+FOODMIN    = 105   # Rations at which the captain diverts for supplies
+EPSILON    = 1e-9
+
+
+## FUNCTIONS
+def distanceMatrix(start, stops):
+    # Builds the table of ranges between the start point (index 0), every stop
+    # (indices 1 to N) and a dummy "end" point (index N+1) that's zero distance
+    # from everything, so an open tour can be treated like a closed one.
+    # Returns an (N+2,N+2) array.
+    pts = np.array([start[:2]] + [s[:2] for s in stops], dtype=float).reshape(-1, 2)
+    D = np.zeros((len(pts)+1, len(pts)+1))
+    D[:-1,:-1] = np.sqrt(((pts[:,None,:] - pts[None,:,:])**2).sum(axis=2))
+    return D
+
+def nearestNeighbour(D):
+    # Seeds a tour by always sailing to the closest stop not yet visited.
+    # Takes a distanceMatrix(), returns the tour as an array of indices that
+    # starts at 0 (the start point) and ends at the dummy end point.
+    n = len(D) - 2
+    route = [0]
+    left = np.ones(n+2, dtype=bool)
+    left[[0, n+1]] = False
+    for _ in range(n):
+        ranges = np.where(left, D[route[-1]], np.inf)
+        nxt = int(np.argmin(ranges))
+        route.append(nxt)
+        left[nxt] = False
+    route.append(n+1)
+    return np.array(route)
+
+def twoOpt(D, route):
+    # Shortens a tour by reversing stretches of it wherever that uncrosses two
+    # legs, until no reversal helps. Returns True if anything changed.
+    changed = False
+    n = len(route) - 2
+    for i in range(1, n):
+        js = np.arange(i+1, n+1)
+        a, b = route[i-1], route[i]
+        c, d = route[js], route[js+1]
+        delta = D[a,c] + D[b,d] - D[a,b] - D[c,d]
+        best = int(np.argmin(delta))
+        if delta[best] < -EPSILON:
+            j = js[best]
+            route[i:j+1] = route[i:j+1][::-1]
+            changed = True
+    return changed
+
+def orOpt(D, route):
+    # Shortens a tour by moving runs of 1-3 stops (possibly reversed) to the
+    # spot in the tour where they fit best. Returns True if anything changed.
+    changed = False
+    for length in (1, 2, 3):
+        i = 1
+        while i + length <= len(route) - 1:
+            seg  = route[i:i+length]
+            rest = np.concatenate((route[:i], route[i+length:]))
+            gain = D[route[i-1], seg[0]] + D[seg[-1], route[i+length]] \
+                   - D[route[i-1], route[i+length]]
+            p, q = rest[:-1], rest[1:]
+            fwd = D[p, seg[0]] + D[seg[-1], q] - D[p, q]
+            rev = D[p, seg[-1]] + D[seg[0], q] - D[p, q]
+            cost = np.minimum(fwd, rev)
+            best = int(np.argmin(cost))
+            if cost[best] < gain - EPSILON:
+                if rev[best] < fwd[best]:
+                    seg = seg[::-1]
+                route[:] = np.concatenate((rest[:best+1], seg, rest[best+1:]))
+                changed = True
+            i += 1
+    return changed
+
+def solveTour(start, stops):
+    # Orders a list of stops (X,Y,...) in to a short open tour starting from
+    # <start>: a nearest-neighbour tour improved with 2-opt and Or-opt moves.
+    # Returns the stops as a reordered list.
+    if len(stops) < 2:
+        return list(stops)
+    D = distanceMatrix(start, stops)
+    route = nearestNeighbour(D)
+    for _ in range(MAXPASSES):
+        improved = twoOpt(D, route)
+        improved = orOpt(D, route) or improved
+        if not improved:
+            break
+    return [stops[i-1] for i in route[1:-1]]
+
+def tourLength(start, stops):
+    # Returns the total distance (nm) of sailing from <start> through <stops>.
+    if len(stops) == 0:
+        return 0
+    pts = np.array([start[:2]] + [s[:2] for s in stops], dtype=float)
+    return float(np.sqrt(((pts[1:] - pts[:-1])**2).sum(axis=1)).sum())
+
+def insertStop(start, stops, stop):
+    # Adds a single stop to a tour at the position where it adds the least
+    # distance, leaving the rest of the tour as it is. Modifies <stops> in
+    # place and returns no output.
+    if len(stops) == 0:
+        stops.append(stop)
+        return
+    pts   = np.array([start[:2]] + [s[:2] for s in stops], dtype=float)
+    toNew = nav.computeRanges(stop, pts)
+    legs  = nav.computeRanges((0, 0), pts[1:] - pts[:-1])
+    cost  = np.append(toNew[:-1] + toNew[1:] - legs, toNew[-1])
+    stops.insert(int(np.argmin(cost)), stop)
+    return
+
+def platformCoords():
+    # Returns the known offshore platforms as an (N,2) array of coordinates.
+    group = dbs.poiGroup('offshore platform')
+    return np.column_stack((np.frombuffer(group.xs, dtype=np.int64),
+                            np.frombuffer(group.ys, dtype=np.int64))).astype(float)
+
+def planStops(start, stops, fuel, fuelEff, fuelCap, food, foodRate, speed):
+    # Walks a tour from <start> with <fuel> liters and <food> rations on
+    # board, burning fuelEff liters per nm and foodRate rations per day at
+    # <speed> knots. Wherever the next leg would leave the ship unable to
+    # reach a platform afterwards (or short on food), a stop at the platform
+    # that adds the least detour is put in first. Returns the list of stops,
+    # as ("contact", (X,Y,type)) or ("platform", (X,Y,"U")) tuples, up to the
+    # point where the ship couldn't go on.
+    platforms = platformCoords()
+    plan = []
+    pos  = start
+    i    = 0
+    while i < len(stops):
+        stop = stops[i]
+        leg  = nav.computeRange(pos, stop)
+        used = leg*fuelEff
+        ate  = leg/max(speed, EPSILON)/24*foodRate
+        if len(platforms) > 0:
+            reserve = nav.computeRanges(stop, platforms).min()*fuelEff
+        else:
+            reserve = 0
+        if used + reserve <= fuel and food - ate >= FOODMIN:
+            plan.append(("contact", stop))
+            fuel -= used
+            food -= ate
+            pos   = stop
+            i    += 1
+            continue
+        # Needs a platform first - pick the reachable one with the least detour
+        if len(platforms) == 0 or (plan and plan[-1][0] == "platform"):
+            break  # Nowhere to resupply, or a full load still won't do it
+        toPlat = nav.computeRanges(pos, platforms)
+        detour = toPlat + nav.computeRanges(stop, platforms)
+        detour[toPlat*fuelEff > fuel] = np.inf
+        best = int(np.argmin(detour))
+        if np.isinf(detour[best]):
+            break
+        pos  = (int(platforms[best,0]), int(platforms[best,1]), "U")
+        plan.append(("platform", pos))
+        food = FOODCAP
+        fuel = fuelCap
+    return plan
+
+def buildRoute(shipLoc):
+    # Replaces the tour with a freshly solved one covering (up to PLANSIZE of)
+    # the unexplored contacts within PLANRADIUS of the ship. Returns the
+    # number of contacts in the tour.
+    global tour
+    nearby = dbs.withinRadius(shipLoc, PLANRADIUS, ['U', 'L'], table="TO_EXPLORE")
+    tour = solveTour(shipLoc, [c[1] for c in nearby[:PLANSIZE]])
+    return len(tour)
+
+def addContacts(contacts, shipLoc):
+    # Works newly detected contacts (X,Y,type) in to the existing tour by
+    # cheapest insertion, rather than solving the tour again. Contacts outside
+    # PLANRADIUS, or beyond PLANSIZE, are left for the next rebuild. Returns no
+    # output.
+    planned = set((s[0], s[1]) for s in tour)
+    for contact in contacts:
+        if len(tour) >= PLANSIZE:
+            break
+        if (contact[0], contact[1]) in planned \
+           or nav.computeRange(shipLoc, contact) > PLANRADIUS:
+            continue
+        insertStop(shipLoc, tour, tuple(contact[:3]))
+        planned.add((contact[0], contact[1]))
+    return
+
+def nextStop(shipState, numCrew):
+    # Decides where the ship should head next: the first contact on the tour,
+    # or a platform if the ship needs fuel or food before it can get there.
+    # Contacts that have been explored (or dropped) since they were planned
+    # are skipped, and the tour is rebuilt when it runs out. Returns a
+    # ("contact" or "platform", (X,Y,type)) tuple, or None if nothing could be
+    # planned.
+    shipLoc = (shipState['shipX'], shipState['shipY'])
+    while tour and dbs.lookupEID(tour[0]) is None:
+        tour.pop(0)
+    if not tour and buildRoute(shipLoc) == 0:
+        return None
+    plan = planStops(shipLoc, tour, shipState['cargo_fuel'], shipState['fuel_eff'],
+                     shipState['fuel_cap'], shipState['cargo_food'], 3*numCrew,
+                     shipState['max_spd'])
+    if len(plan) == 0:
+        return None
+    if plan[0][0] == "contact":
+        tour.pop(0)
+    return plan[0]
+
+
+## INITIALIZATION
+tour = []  # Planned contacts (X,Y,type), in the order they'll be visited
+
+
+## UNIT TESTS
+if __name__ == "__main__":
+    import random
+    random.seed(1)
+
+    print("TEST: solveTour()")
+    stops = [(random.randrange(-200, 200), random.randrange(-200, 200), "U") for _ in range(60)]
+    naive = tourLength((0, 0), stops)
+    solved = solveTour((0, 0), stops)
+    print(f"    Same stops              : Expect True : Got {sorted(solved) == sorted(stops)}")
+    print(f"    Shorter than given order: Expect True : Got {tourLength((0, 0), solved) < naive}")
+    print(f"    ({naive:.0f}nm as given, {tourLength((0, 0), solved):.0f}nm solved)")
+    print("")
+
+    print("TEST: insertStop()")
+    stops = [(10, 0, "U"), (20, 0, "U"), (30, 0, "U")]
+    insertStop((0, 0), stops, (15, 1, "L"))
+    print(f"    Inserted in between     : Expect 1 : Got {stops.index((15, 1, 'L'))}")
+    print("")
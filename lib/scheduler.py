@@ -0,0 +1,288 @@
+#!/bin/python3
+
+## CHIP'S OCEAN GAME (COG) SCHEDULER
+##
+## Decides how much game time each pass of the main loop covers, and when
+## random events happen. Normally the loop runs in real time, paced by a
+## Clock. With the 'timeSkip' save flag set, it instead advances straight to
+## the next moment something can actually change (arriving at the track, new
+## grid squares coming in to sensor range, running low on fuel, a new day, the
+## next event in the EventQueue) rather than grinding through it 5 seconds at
+## a time.
+
+
+## IMPORTS AND CONSTANTS
+import math
+import heapq
+from time import monotonic, sleep
+
+import lib.navigation as nav
+import lib.dbServices as dbs
+
+TICK    = 5     # Length of a standard game tick (seconds)
+MINSTEP = 1     # Shortest step the scheduler will hand out (seconds)
+MAXSTEP = 3600  # Longest step the scheduler will hand out (seconds)
+FUELLOW = 0.333 # Fuel fraction at which the captain starts looking for fuel
+SLACK   = 0.01  # Extra time added so a step lands just past a boundary
+POLICIES = [ "coalesce", "replay", "drop" ]  # Clock catch-up policies
+
+# Average game time between occurrences of events that happen "about once a
+# <period>" (seconds)
+PERIODS = { "daily"   : 86400,   "bidaily"   : 172800,
+            "weekly"  : 604800,  "biweekly"  : 1209600,
+            "monthly" : 2592000, "bimonthly" : 5184000 }
+
+
+## CLASSES
+class Clock:
+    # Paces the main loop in real time against absolute deadlines on the
+    # monotonic clock, one every <period> seconds from when it was started,
+    # so slow ticks and rounding can't make game time drift. If the loop
+    # falls behind (an away team exploring, say), <policy> decides what
+    # happens to the ticks it missed:
+    #   coalesce - their time all goes to the next tick
+    #   replay   - they're run as extra ticks, at most <replayMax> of them,
+    #              with any time beyond that shared out between them
+    #   drop     - their time is thrown away and the game falls behind
+    # Game time runs <scale> times as fast as real time. The ship's clock
+    # counts whole seconds, so fractions of a second are carried over to the
+    # next tick rather than rounded away, and a tick never gets less than a
+    # second of game time (so each tick must cover at least that much).
+    def __init__(self, period=TICK, policy="coalesce", replayMax=12, scale=1):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown catch-up policy '{policy}'")
+        if period*scale < 1:
+            raise ValueError("Clock ticks must cover at least a second of game time")
+        self.period    = period
+        self.policy    = policy
+        self.replayMax = max(1, replayMax)
+        self.scale     = scale
+        self.mark      = monotonic()  # Real time handed out to the game so far
+        self.deadline  = self.mark + period
+        self.carry     = 0.0          # Fraction of a second not yet handed out
+        self.dropped   = 0.0          # Seconds thrown away by "drop"
+
+    def wait(self):
+        # Sleeps until the next tick is due (and has a whole second of game
+        # time to its name), unless it already is. Returns the game time
+        # (whole seconds) for each of the ticks now due as a list: just the
+        # one, unless missed ticks are being replayed.
+        whole = 0
+        while whole < 1:
+            now = monotonic()
+            if now < self.deadline:
+                sleep(self.deadline - now)
+                now = max(monotonic(), self.deadline)
+            missed = math.floor((now - self.deadline)/self.period)
+            self.deadline += (missed + 1)*self.period
+            elapsed   = (now - self.mark)*self.scale + self.carry
+            self.mark = now
+            if missed > 0 and self.policy == "drop":
+                self.dropped += elapsed - self.period*self.scale
+                elapsed = self.period*self.scale
+            whole      = math.floor(elapsed)
+            self.carry = elapsed - whole
+        if missed > 0 and self.policy == "replay":
+            return split(whole, min(missed + 1, self.replayMax, whole))
+        return [whole]
+
+
+class EventQueue:
+    # Random events that happen at some average rate (storms, malfunctions,
+    # personal logs...). Rather than rolling for every event on every tick,
+    # the time of each event's next occurrence is drawn up front from the
+    # exponential distribution and kept in a heap, so nothing is spent on
+    # events that aren't due and it makes no difference how long the ticks
+    # are. Being memoryless, the queue needn't be saved: drawing fresh times
+    # after a restart is just as good. Times are in game seconds (see
+    # gameTime()) and draws come from random stream <gen>.
+    def __init__(self, gen):
+        self.gen     = gen
+        self.periods = {}
+        self.heap    = []     # (due time, event name)
+        self.fired   = {}     # Times each event came due in the last advance()
+
+    def add(self, name, period, now):
+        # Starts scheduling event <name>, which happens on average once every
+        # <period> (seconds, or a key of PERIODS) from game time <now>.
+        self.periods[name] = PERIODS.get(period, period)
+        self.schedule(name, now)
+        return
+
+    def schedule(self, name, after):
+        # Draws the next occurrence of event <name> after game time <after>.
+        due = after + self.gen.expovariate(1/self.periods[name])
+        heapq.heappush(self.heap, (due, name))
+        return
+
+    def advance(self, now):
+        # Moves the queue up to game time <now>. Returns a dict of the events
+        # that came due and how many times each came up.
+        self.fired = {}
+        while self.heap and self.heap[0][0] <= now:
+            due, name = heapq.heappop(self.heap)
+            self.fired[name] = self.fired.get(name, 0) + 1
+            self.schedule(name, due)
+        return self.fired
+
+    def happened(self, name):
+        # Returns the number of times event <name> came due in the last
+        # advance(), 0 if it didn't.
+        return self.fired.get(name, 0)
+
+    def nextDue(self):
+        # Returns the game time the next event is due at.
+        return self.heap[0][0] if self.heap else math.inf
+
+
+## FUNCTIONS
+def gameTime(shipState):
+    # Returns the ship's clock as a single count of game seconds.
+    return (shipState['day']-1)*86400 + shipState['tStamp']
+
+def split(t, n):
+    # Shares <t> whole seconds out as evenly as possible between <n> steps.
+    # Returns the steps as a list of ints.
+    return [t*(i+1)//n - t*i//n for i in range(n)]
+
+def subSteps(t, maxStep):
+    # Breaks a step of <t> seconds in to the fewest even pieces that are no
+    # longer than <maxStep>, so the ship is never moved too far in one go.
+    # Returns the pieces as a list of ints.
+    return split(t, max(1, math.ceil(t/maxStep)))
+
+def velocity(shipState):
+    # Returns the ship's current velocity as an (X,Y) tuple in nm per second.
+    speed   = shipState['spd']/3600
+    heading = math.radians(shipState['hdg'])
+    return (speed*math.sin(heading), speed*math.cos(heading))
+
+def timeToArrival(shipState):
+    # Seconds until the ship reaches its track (at its current speed), or
+    # infinity if it has no track or isn't moving.
+    track = dbs.lookupContact(shipState['trackID'])
+    if track is None or shipState['spd'] <= 0:
+        return math.inf
+    distance = nav.computeRange((shipState['shipX'], shipState['shipY']), track)
+    return nav.computeETA(shipState['spd'], distance)*60
+
+def timeToEdge(position, speed):
+    # Seconds until a coordinate moving at <speed> (per second) reaches the
+    # next half-way point between grid squares, which is where rounding it
+    # (see worldgen.findBounds) gives a different square. Returns infinity if
+    # it isn't moving.
+    if speed == 0:
+        return math.inf
+    if speed > 0:
+        edge = math.floor(position - 0.5) + 1.5
+    else:
+        edge = math.ceil(position + 0.5) - 1.5
+    return (edge - position)/speed
+
+def timeToNewCells(shipState, sensorRanges):
+    # Seconds until any sensor's search box (see worldgen.sensorSweep) takes
+    # in a new row or column of grid squares. Takes the effective range of
+    # each sensor as a list.
+    vx, vy = velocity(shipState)
+    times = [math.inf]
+    for rng in sensorRanges:
+        x, y = shipState['shipX'], shipState['shipY']
+        for edge in [x-rng, x+rng]:
+            times.append(timeToEdge(edge, vx))
+        for edge in [y-rng, y+rng]:
+            times.append(timeToEdge(edge, vy))
+    return min(times)
+
+def timeToFuelEvent(shipState):
+    # Seconds until the fuel drops below the captain's low-fuel threshold, or
+    # runs out if it's already below it. Infinity if the ship isn't moving or
+    # is already out of fuel.
+    burn = shipState['fuel_eff']*shipState['spd']/3600  # Liters per second
+    fuel = shipState['cargo_fuel']
+    if burn <= 0 or fuel <= 0:
+        return math.inf
+    low  = shipState['fuel_cap']*FUELLOW
+    return (fuel-low)/burn if fuel > low else fuel/burn
+
+def timeToNewDay(shipState):
+    # Seconds until the ship's clock rolls over to the next day.
+    return 86400 - shipState['tStamp']
+
+def nextStep(shipState, sensorRanges, eventTime=math.inf):
+    # Decides how many seconds the simulation can jump ahead in one step: up to
+    # the first of arrival, new sensor coverage, a fuel threshold, the next day
+    # or <eventTime> (the next scheduled random event), within MINSTEP and
+    # MAXSTEP. The ship's clock counts whole seconds, so the step is rounded
+    # up. Returns the step length in seconds as an int.
+    step = min(timeToArrival(shipState),
+               timeToNewCells(shipState, sensorRanges) + SLACK,
+               timeToFuelEvent(shipState) + SLACK,
+               timeToNewDay(shipState),
+               eventTime,
+               MAXSTEP)
+    return max(MINSTEP, math.ceil(step))
+
+
+## UNIT TESTS
+if __name__ == "__main__":
+    print("TEST: timeToEdge()")
+    print(f"    Moving +1/s from 0.2  : Expect 0.3 : Got {round(timeToEdge(0.2, 1), 9)}")
+    print(f"    Moving -2/s from 0.2  : Expect 0.35 : Got {round(timeToEdge(0.2, -2), 9)}")
+    print(f"    Rounds differently    : Expect True : Got {round(0.2 + 0.3 + SLACK) != round(0.2)}")
+    print("")
+
+    print("TEST: subSteps()")
+    print(f"    Short step untouched  : Expect [5] : Got {subSteps(5, 60)}")
+    print(f"    Long step split evenly: Expect [50, 50, 50] : Got {subSteps(150, 60)}")
+    print("")
+
+    print("TEST: Clock")
+    clock = Clock(0.05, "coalesce", scale=20)  # A game second every 0.05s
+    start = clock.mark
+    steps = [step for _ in range(10) for step in clock.wait()]
+    print(f"    Never hands out 0s    : Expect True : Got {min(steps) >= 1}")
+    drift = sum(steps) + clock.carry - (clock.mark - start)*20
+    print(f"    Doesn't drift         : Expect True : Got {abs(drift) < 1e-6}")
+    clock.mark -= 3.3  # Pretend the last tick ran 3.3 seconds long
+    clock.deadline -= 3.3
+    steps = clock.wait()
+    print(f"    Coalesces missed time : Expect 1 step of 66+ : Got {len(steps)} step of {steps[0]}")
+    clock = Clock(0.05, "replay", replayMax=4, scale=20)
+    clock.mark -= 10
+    clock.deadline -= 10
+    steps = clock.wait()
+    print(f"    Replay is bounded     : Expect 4 : Got {len(steps)}")
+    print(f"    Replay keeps the time : Expect 200+ : Got {sum(steps)}")
+    clock = Clock(0.05, "drop", scale=20)
+    clock.mark -= 10
+    clock.deadline -= 10
+    print(f"    Drops missed time     : Expect [1] : Got {clock.wait()}")
+    try:
+        Clock(0.5)
+        print("    Refuses 0s ticks      : Expect True : Got False")
+    except ValueError:
+        print("    Refuses 0s ticks      : Expect True : Got True")
+    print("")
+
+    print("TEST: EventQueue")
+    import random
+    queue = EventQueue(random.Random(1))
+    queue.add("often", 100, 0)
+    queue.add("rare", "monthly", 0)
+    hits = sum(queue.advance(t).get("often", 0) for t in range(5, 1000005, 5))
+    print(f"    Hits at the set rate  : Expect 10000 +/-300 : Got {hits} ({abs(hits-10000) <= 300})")
+    queue = EventQueue(random.Random(1))
+    queue.add("daily", "daily", 0)
+    hits = sum(queue.advance(t).get("daily", 0) for t in range(3600, 1000*86400+1, 3600))
+    print(f"    Hourly ticks keep up  : Expect 1000 +/-95 : Got {hits} ({abs(hits-1000) <= 95})")
+    print(f"    Next due is ahead     : Expect True : Got {queue.nextDue() > 1000*86400}")
+    queue = EventQueue(random.Random(1))
+    queue.add("often", 100, 0)
+    hits = queue.advance(1000000).get("often", 0)
+    print(f"    One long step counts  : Expect 10000 +/-300 : Got {hits} ({abs(hits-10000) <= 300})")
+    print("")
+
+    print("TEST: timeToFuelEvent()")
+    ship = { "spd" : 10, "hdg" : 90, "fuel_eff" : 10, "cargo_fuel" : 1000, "fuel_cap" : 1000 }
+    print(f"    Hits low-fuel mark    : Expect {round(667/(100/3600))} : Got {round(timeToFuelEvent(ship))}")
+    print("")
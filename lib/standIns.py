@@ -0,0 +1,93 @@
+#!/bin/python3
+
+## CHIP'S OCEAN GAME (COG) STAND-INS
+##
+## Offline replacements for the services COG talks to over the network, used
+## by headless runs (see cog.py --headless). The functions match the ones in
+## lib/AIengine.py and Subreddit matches the parts of PRAW's subreddit that
+## COG uses, so any module laid out like this one can be plugged in instead
+## with --standins.
+
+
+## IMPORTS AND CONSTANTS
+import logging
+from concurrent.futures import Future
+from itertools import count
+
+from lib.configManager import loadConfig
+
+confFile = "./etc/main.conf"
+
+
+## CLASSES
+class Subreddit:
+    # Takes the place of a PRAW subreddit. Posts are counted and logged, but
+    # don't go anywhere.
+    def __init__(self, name):
+        self.name   = name
+        self.posts  = 0
+        self.images = 0
+
+    def submit(self, title, text):
+        self.posts += 1
+        logging.debug(f"STAND-IN: Would have posted '{title}' to r/{self.name}")
+        return
+
+    def submit_gallery(self, title, gallery):
+        self.posts  += 1
+        self.images += len(gallery)
+        logging.debug(f"STAND-IN: Would have posted {len(gallery)} images to r/{self.name}")
+        return
+
+
+## FUNCTIONS
+def getPOIdescription(pProps, size):
+    # Same as AIengine.getPOIdescription(), returns the description as a
+    # string.
+    return f"{pProps['name']} is a {pProps['adj']} {pProps['type']}."
+
+def getObjectDescription(type, pProps, story=""):
+    # Same as AIengine.getObjectDescription(), returns the description as a
+    # string.
+    return f"The crew found a {type} at {pProps['name']}."
+
+def getName(thing):
+    # Same as AIengine.getName(). Names are numbered so they stay unique.
+    # Returns the name as a string.
+    return f"{thing} {next(serial)}".title()
+
+def getImage(tprompt, tag):
+    # Same as AIengine.getImage(), but no image gets made. Returns the
+    # filename of the placeholder image.
+    return conf['err_noimage']
+
+def getPersonalLog(name, ship, role="", event="", prevlog=""):
+    # Same as AIengine.getPersonalLog(), returns the log text as a string.
+    if event != "":
+        return f"{role} {name} here. We recently {event}."
+    return f"{role} {name} here. Another day aboard the {ship}."
+
+def submit(onDone, func, *args):
+    # Same as AIengine.submit(), except func(*args) runs straight away (the
+    # stand-ins are quick) so headless runs stay repeatable. Its result still
+    # waits for collect(). Returns the job's (already finished) Future.
+    result = func(*args)
+    pending.append((result, onDone))
+    future = Future()
+    future.set_result(result)
+    return future
+
+def collect(wait=False):
+    # Same as AIengine.collect(). Returns the number of jobs collected.
+    done = 0
+    while pending:
+        result, onDone = pending.pop(0)
+        onDone(result)
+        done += 1
+    return done
+
+
+## INITIALIZATION
+conf    = loadConfig(confFile)
+serial  = count(1)  # Numbers handed out by getName()
+pending = []        # Finished jobs as (result, onDone) tuples
@@ -7,12 +7,98 @@
 
 ## IMPORTS AND CONSTANTS
 import random
+import hashlib
+import sqlite3
+import json
+import logging
+from struct import error as StructError
+from collections import OrderedDict
+from math import floor
+from bisect import bisect
+from itertools import accumulate
+
+import numpy as np
 
 import lib.AIengine as ai
+import lib.atlas as atlas
+import lib.rngService as rngs
 from lib.configManager import loadConfig
 
 confFile = "./etc/main.conf"  # Location of config file
 
+# Constants for the "fast" sweep engine's counter-based hash. The odd
+# multiplier is the 64-bit golden ratio, and the sensor codes keep each
+# sensor's contact field independent (just like the sensor type being part of
+# the seed string in "compat" mode).
+GOLDEN      = np.uint64(0x9E3779B97F4A7C15)
+SENSORCODES = { "visual" : 1, "radar" : 2, "sonar" : 3 }
+TILESIZE    = 64  # Width/height (in grid squares) of a contact cache tile
+FIXEDRSRC   = [ "offshore platform", "ship", "wreck", "coral", "deposit" ]
+
+
+## CLASSES
+class WorldModel:
+    # Precompiled POI distributions. Built once from the probability and type
+    # configs so that generating a POI doesn't have to rebuild weight lists or
+    # reseed for the hull's weirdness nudge. Draws are made exactly the same
+    # way random.choices()/random.choice() make them, so a given grid seed
+    # still produces the same POI in "compat" RNG mode.
+    def __init__(self, hull, probs, types):
+        self.poiTypes = {}  # Keyed by "U"/"L": (types, cumulative weights)
+        for cType, key in [("U", "surface_pois"), ("L", "submerged_pois")]:
+            pTypes = tuple(types[key])
+            cumWeights = list(accumulate(probs[f"weight_poi_{t}"] for t in pTypes))
+            self.poiTypes[cType] = (pTypes, cumWeights)
+        allTypes = types['surface_pois'] + types['submerged_pois']
+        self.resources  = { t : tuple(types[f"resource_{t}"]) for t in allTypes }
+        self.adjectives = tuple(types['adjectives'])
+        self.nudge      = random.Random(hull).uniform(-1, 1)
+
+    def drawType(self, cType, gen):
+        # Picks a POI type for a surface ("U") or submerged ("L") contact
+        # using generator <gen>. Returns the type as a string.
+        pTypes, cumWeights = self.poiTypes[cType]
+        roll = gen.random() * cumWeights[-1]
+        return pTypes[bisect(cumWeights, roll, 0, len(pTypes)-1)]
+
+    def getResources(self, type, gSeed):
+        # Determines the resources available at a POI of <type> located in
+        # the grid square with seed <gSeed>. Returns a list of resources.
+        if type in FIXEDRSRC:
+            return list(self.resources[type])
+        gen = rngs.getStream("resources", gSeed, legacy=gSeed)
+        resources = []
+        while len(resources) < 2:
+            c = gen.choice(self.resources[type])
+            if c not in resources:
+                resources.append(c)
+        return resources
+
+    def computeWeird(self, contact):
+        # Weirdness (1-10) for a contact, based on its latitude plus the hull's
+        # nudge. Returns an int.
+        nudgeWeird = (contact[1]/1000)*10 + self.nudge
+        if nudgeWeird < 1:
+            return 1
+        elif nudgeWeird > 10:
+            return 10
+        return round(nudgeWeird)
+
+    def makePOI(self, contact):
+        # Generates the full property dictionary for a contact, asking the AI
+        # engine for a name. Returns the dictionary.
+        gSeed = makeGridSeed(contact[0], contact[1])
+        gen = rngs.getStream("poi", gSeed, contact[2], legacy=gSeed)
+        pType = self.drawType(contact[2], gen)
+        pProps = {}
+        pProps['loc']       = (contact[0], contact[1])
+        pProps['type']      = pType
+        pProps['name']      = ai.getName(pType)
+        pProps['adj']       = gen.choice(self.adjectives)
+        pProps['weirdness'] = self.computeWeird(contact)
+        pProps['resources'] = self.getResources(pType, gSeed)
+        return pProps
+
 
 ## FUNCTIONS
 def findBounds(origin, radius):
@@ -42,78 +128,288 @@ def getWeights(typeList):
         weights.append(probs[goString])
     return weights
 
-def sensorSweep(shipLoc, rng, type="visual"):
+def makeHullKey(hull):
+    # Boils the hull number down to a 64-bit integer key for the fast sweep
+    # engine. Takes the hull number (string) as input, returns an int.
+    digest = hashlib.blake2b(str(hull).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+def sensorProfile(type):
+    # Maps a sensor type to the kind of contact it detects and the chance of
+    # a given grid square holding one. Returns a tuple of ("U" or "L", chance),
+    # or None if the sensor type isn't recognized.
+    if type == "radar" or type == "visual":
+        return ("U", probs['chanceSurfacePOI'])
+    elif type == "sonar":
+        return ("L", probs['chanceSubPOI'])
+    return None
+
+def mix64(z):
+    # SplitMix64 finalizer. Scrambles an array of uint64 values so that every
+    # input bit affects every output bit. Takes and returns a NumPy array.
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def hashRolls(xs, ys, type):
+    # Counter-based replacement for reseeding the PRNG on every grid square.
+    # Takes arrays of X and Y grid coordinates plus the sensor type, returns an
+    # array of uniform floats in [0,1) - one roll per grid square.
+    h = np.full(np.shape(xs), hullKey ^ SENSORCODES.get(type, 0), dtype=np.uint64)
+    h = mix64(h + np.asarray(xs, dtype=np.int64).astype(np.uint64)*GOLDEN)
+    h = mix64(h + np.asarray(ys, dtype=np.int64).astype(np.uint64)*GOLDEN)
+    return (h >> np.uint64(11)).astype(np.float64) * 2.0**-53
+
+def scanBoxCompat(box, type):
+    # Generates the contacts inside a search box ([x1,y1, x2,y2] as given by
+    # findBounds) exactly the way the original engine did: by seeding a PRNG
+    # with each grid square's seed string and taking one roll. Slow, but it
+    # reproduces existing worlds. Returns a list of lists (x,y,"U"/"L").
+    foundContacts = []
+    profile = sensorProfile(type)
+    if profile is None:
+        return foundContacts
+    cType, chance = profile
+    gen = random.Random()
+    for y in range(box[1], box[3], -1):   # Step is negative because we're
+        for x in range(box[0], box[2]):   # starting at top Y value and
+            gen.seed(f"{makeGridSeed(x,y)}{type}")  # working down.
+            if gen.random() <= chance:
+                foundContacts.append([x,y,cType])
+    return foundContacts
+
+def scanBoxFast(box, type):
+    # Generates the contacts inside a search box using the counter-based hash,
+    # evaluating the whole box as a single array. Contacts come back in the
+    # same order as scanBoxCompat() (top row first, left to right).
+    profile = sensorProfile(type)
+    if profile is None or box[2] <= box[0] or box[1] <= box[3]:
+        return []
+    cType, chance = profile
+    ys, xs = np.mgrid[box[1]:box[3]:-1, box[0]:box[2]]
+    hits = hashRolls(xs, ys, type) <= chance
+    return [[int(x), int(y), cType] for x, y in zip(xs[hits], ys[hits])]
+
+def generateBox(box, type):
+    # Dispatches a search box to whichever sweep engine this world uses (set
+    # by 'sweepmode' in the main config). Returns a list of lists (x,y,"U"/"L").
+    if sweepMode == "fast":
+        return scanBoxFast(box, type)
+    return scanBoxCompat(box, type)
+
+def tileBox(tx, ty, clip=None):
+    # Builds the search box ([x1,y1, x2,y2]) covering tile (tx,ty), optionally
+    # clipped to another search box. Returns the box as a list.
+    x1 = tx*TILESIZE
+    y1 = ty*TILESIZE + TILESIZE-1
+    tBox = [x1, y1, x1+TILESIZE, y1-TILESIZE]
+    if clip is not None:
+        tBox = [max(tBox[0], clip[0]), min(tBox[1], clip[1]),
+                min(tBox[2], clip[2]), max(tBox[3], clip[3])]
+    return tBox
+
+def getTile(type, tx, ty):
+    # Fetches the contacts in tile (tx,ty) for a given sensor type, generating
+    # them if the tile isn't in the cache yet. Tiles are TILESIZE squares wide
+    # with tile (0,0) covering grid squares 0 to TILESIZE-1 on both axes.
+    # Returns the tile's contacts as a tuple of (x,y,"U"/"L") tuples.
+    key = (type, tx, ty)
+    tile = tileCache.get(key)
+    if tile is not None:
+        tileCache.move_to_end(key)
+        tileStats['hits'] += 1
+        return tile
+
+    tileStats['misses'] += 1
+    tile = tuple(tuple(c) for c in generateBox(tileBox(tx, ty), type))
+    tileCache[key] = tile
+    if len(tileCache) > tileCacheSize:
+        tileCache.popitem(last=False)  # Evict least recently used tile
+        tileStats['evictions'] += 1
+    return tile
+
+def getCacheStats():
+    # Reports how well the contact tile cache is doing. Returns a dictionary
+    # of hit/miss/eviction counters along with the cache's size and capacity.
+    stats = dict(tileStats)
+    stats['tiles']    = len(tileCache)
+    stats['capacity'] = tileCacheSize
+    return stats
+
+def scanBox(box, type):
+    # Finds the contacts inside a search box ([x1,y1, x2,y2] as given by
+    # findBounds). Tiles covered by the world atlas are read from it, the rest
+    # come from the tile cache (or are generated directly if the cache is
+    # disabled). Returns a list of lists (x,y,"U"/"L") ordered top row first,
+    # left to right.
+    profile = sensorProfile(type)
+    if profile is None or box[2] <= box[0] or box[1] <= box[3]:
+        return []
+    if tileCacheSize <= 0 and atlas.atlas is None:
+        return generateBox(box, type)
+
+    cType = profile[0]
+    code  = SENSORCODES[type]
+    foundContacts = []
+    for ty in range(floor((box[3]+1)/TILESIZE), floor(box[1]/TILESIZE)+1):
+        for tx in range(floor(box[0]/TILESIZE), floor((box[2]-1)/TILESIZE)+1):
+            if atlas.hasTile(code, tx, ty):
+                for x, y in atlas.queryTile(code, tx, ty, box):
+                    foundContacts.append([x,y,cType])
+            elif tileCacheSize > 0:
+                for c in getTile(type, tx, ty):
+                    if box[0] <= c[0] < box[2] and box[3] < c[1] <= box[1]:
+                        foundContacts.append(list(c))
+            else:
+                foundContacts.extend(generateBox(tileBox(tx, ty, box), type))
+    foundContacts.sort(key=lambda c: (-c[1], c[0]))
+    return foundContacts
+
+def loadAtlas(filename):
+    # Opens a pregenerated world atlas (see atlasgen.py) so that sweeps inside
+    # its region are read from disk instead of generated. Returns True if the
+    # atlas matches this world and was opened, False if it doesn't match or
+    # can't be read (missing, truncated...), in which case contacts just get
+    # generated as usual.
+    try:
+        return atlas.openAtlas(filename, hullKey, sweepMode, TILESIZE,
+                               probs['chanceSurfacePOI'], probs['chanceSubPOI'])
+    except (OSError, ValueError, TypeError, StructError) as e:
+        logging.warning(f"Couldn't read atlas {filename}: {e}")
+        return False
+
+def boxDifference(new, old):
+    # Works out which parts of search box <new> aren't covered by search box
+    # <old> (both [x1,y1, x2,y2] as given by findBounds). Returns a list of up
+    # to four non-overlapping boxes: full-width strips for the rows that
+    # entered range, then the left/right edges of the rows in between.
+    ix1 = max(new[0], old[0])
+    ix2 = min(new[2], old[2])
+    iy1 = min(new[1], old[1])
+    iy2 = max(new[3], old[3])
+    if ix1 >= ix2 or iy1 <= iy2:  # No overlap at all
+        return [new]
+    strips = []
+    if new[1] > iy1:
+        strips.append([new[0], new[1], new[2], iy1])
+    if iy2 > new[3]:
+        strips.append([new[0], iy2, new[2], new[3]])
+    if ix1 > new[0]:
+        strips.append([new[0], iy1, ix1, iy2])
+    if new[2] > ix2:
+        strips.append([ix2, iy1, new[2], iy2])
+    return strips
+
+def resetSweeps():
+    # Forgets the previously swept boxes, so the next delta sweep for every
+    # sensor covers its full range again.
+    lastSweep.clear()
+    return
+
+def sensorSweep(shipLoc, rng, type="visual", delta=False):
     # Primary function driving POI detection. Takes in ship's X,Y coordinates
     # as a list, range of the given sensor, and the type of sensor. Returns the
     # generated POIs as a list of lists(x,y,"U" or "L" to denote surface/sub).
-    foundContacts = []
+    # If <delta> is set then only the grid squares that have come in to range
+    # since this sensor's last delta sweep are searched (and nothing at all if
+    # the search box hasn't changed).
     searchBox = findBounds(shipLoc, rng)
-    for y in range(searchBox[1], searchBox[3], -1):  # Step is negative because
-        for x in range(searchBox[0], searchBox[2]):  # we're starting at top Y
-            random.seed(f"{makeGridSeed(x,y)}{type}")# value and working down.
-            roll = random.random()
-            if type == "radar" or type == "visual":
-                if roll <= probs['chanceSurfacePOI']:
-                    foundContacts.append([x,y,"U"])
-            elif type == "sonar":
-                if roll <= probs['chanceSubPOI']:
-                    foundContacts.append([x,y,"L"])
+    if not delta:
+        return scanBox(searchBox, type)
+
+    prevBox = lastSweep.get(type)
+    lastSweep[type] = searchBox
+    if prevBox is None:
+        return scanBox(searchBox, type)
+    foundContacts = []
+    if prevBox != searchBox:
+        for strip in boxDifference(searchBox, prevBox):
+            foundContacts.extend(scanBox(strip, type))
     return foundContacts
 
 def getResources(type, gSeed):
     # Determines the resources available to a POI at a given set of coordinates.
     # Takes as input the POI type and the gridSeed. Returns a list of resources.
-    resources = []
-    i = 0
-    random.seed(gSeed)
-    typeString = f"resource_{type}"
-    
-    if type in ["offshore platform", "ship", "wreck", "coral", "deposit"]:
-        return types[typeString]
-    numResource = 2
-    while i < numResource:
-        c = random.choice(types[typeString])
-        if c not in resources:
-            resources.append(c)
-            i += 1
-    return resources
+    return model.getResources(type, gSeed)
 
 def computeWeird(contact):
     # Computes the level of "weirdness" for a given coordinate on a scale of
     # 1 to 10. Generally, the more extreme your latitude the more weird things
     # get. Takes a contact as input and returns an int in range 1-10 as output.
-    random.seed(conf['hull'])
-    lat = contact[1]
-    nudge = random.uniform(-1, 1)
-    baseWeird = (lat/1000)*10
-    nudgeWeird = baseWeird+nudge
-    if nudgeWeird < 1:
-        weird = 1
-    elif nudgeWeird > 10:
-        weird = 10
-    else:
-        weird = round(nudgeWeird)
-    return weird
+    return model.computeWeird(contact)
+
+def openMemo(filename=None):
+    # Opens (creating if needed) the POI property memo - a small database in
+    # the save directory that remembers every POI generated so far. Entries
+    # are kept per generator mode (see memoKey()). Leaves the connection as
+    # the global 'memo'. Returns no output.
+    global memo
+    if filename is None:
+        filename = f"./{conf['savedir']}/{conf.get('memoname', 'poimemo.db')}"
+    memo = sqlite3.connect(filename)
+    columns = [row[1] for row in memo.execute("PRAGMA table_info(POI_MEMO);")]
+    if columns and "gmode" not in columns:
+        # Memos from before the modes were recorded can't be trusted
+        logging.info("POI memo predates generator modes, starting it afresh.")
+        memo.execute("DROP TABLE POI_MEMO;")
+    memo.execute(""" CREATE TABLE IF NOT EXISTS POI_MEMO (
+                     gseed TEXT,
+                     class TEXT,
+                     gmode TEXT,
+                     props TEXT,
+                     PRIMARY KEY (gseed, class, gmode)); """)
+    memo.commit()
+    return
+
+def memoKey(contact):
+    # Builds the memo key for a contact (X, Y, "U"/"L"). The sweep and RNG
+    # modes are part of it, since POIs come out differently under each, so
+    # switching a save's modes never brings back properties from the old
+    # ones. Returns a (grid seed, class, generator mode) tuple.
+    return (makeGridSeed(contact[0], contact[1]), contact[2],
+            f"{sweepMode}/{rngs.rngMode}")
+
+def lookupPOI(contact):
+    # Fetches a POI's properties from the memo without generating anything.
+    # Takes a contact (X, Y, "U"/"L"), returns the property dictionary or None
+    # if the POI hasn't been generated yet.
+    key = memoKey(contact)
+    if key in memoCache:
+        return dict(memoCache[key])
+    if memo is None:
+        openMemo()
+    cursor = memo.cursor()
+    cursor.execute("SELECT props FROM POI_MEMO WHERE gseed == ? AND class == ? AND gmode == ?;", key)
+    result = cursor.fetchone()
+    cursor.close()
+    if result is None:
+        return None
+    pProps = json.loads(result[0])
+    pProps['loc'] = tuple(pProps['loc'])
+    memoCache[key] = pProps
+    return dict(pProps)
+
+def storePOI(contact, pProps):
+    # Records a freshly generated POI's properties in the memo. Takes the
+    # contact and its property dictionary, returns no output.
+    key = memoKey(contact)
+    if memo is None:
+        openMemo()
+    command = "INSERT OR REPLACE INTO POI_MEMO (gseed, class, gmode, props) VALUES (?, ?, ?, ?);"
+    memo.execute(command, (*key, json.dumps(pProps)))
+    memo.commit()
+    memoCache[key] = dict(pProps)
+    return
 
 def getPOI(contact):
     # Get the properties of a found POI - takes in a contact (tuple containing
     # X coord, Y coord, and Surface/Submerged identifier), returns a dictionary
-    # containing the POI properties.
-    gSeed = makeGridSeed(contact[0], contact[1])
-    pProps = {}
-
-    random.seed(gSeed)
-    pTypes = types['surface_pois'] if contact[2] == "U" else types['submerged_pois']
-    pWeights = getWeights(pTypes)
-    pType = random.choices(pTypes, weights=pWeights)[0]  # Index of 0 because
-                                                         # random.choices returns
-    pProps['loc']       = (contact[0], contact[1])       # as a single-element
-    pProps['type']      = pType                          # list.
-    pProps['name']      = ai.getName(pType)
-    pProps['adj']       = random.choice(types['adjectives'])
-    pProps['weirdness'] = computeWeird(contact)
-    pProps['resources'] = getResources(pType, gSeed)
-
+    # containing the POI properties. POIs are only generated (and named) once;
+    # after that their properties come from the memo.
+    pProps = lookupPOI(contact)
+    if pProps is None:
+        pProps = model.makePOI(contact)
+        storePOI(contact, pProps)
     return pProps
 
 
@@ -122,12 +418,29 @@ conf  = loadConfig(confFile)
 probs = loadConfig(f"./{conf['probfile']}")
 types = loadConfig(f"./{conf['typefile']}")
 random.seed(conf["hull"])
+model     = WorldModel(conf['hull'], probs, types)
+sweepMode = conf.get('sweepmode', "compat")  # Older configs predate the
+hullKey   = makeHullKey(conf['hull'])        # fast engine.
+lastSweep = {}  # Most recent delta sweep box, keyed by sensor type
+memo      = None  # POI property memo, opened on first use (see openMemo())
+memoCache = {}
+
+tileCacheSize = conf.get('tilecache', 1024)  # Max number of cached tiles
+tileCache     = OrderedDict()
+tileStats     = { "hits" : 0, "misses" : 0, "evictions" : 0 }
+
+if conf.get('atlasfile'):
+    if not loadAtlas(f"./{conf['atlasfile']}"):
+        logging.warning(f"Atlas {conf['atlasfile']} can't be used with this world - generating contacts instead")
 
 
 ## UNIT TESTS
 if __name__ == "__main__":
     conf['hull'] = "TEST"  # Override hull number (a.k.a. master PRNG seed) to
                            # a known value
+    hullKey = makeHullKey(conf['hull'])
+    model = WorldModel(conf['hull'], probs, types)
+    sweepMode = "compat"
 
     # Testing findBounds()
     print("TEST: findBounds()")
@@ -150,6 +463,46 @@ if __name__ == "__main__":
     print(f"    Submerged Contacts : Expected 2 : Got {numSub}")
     print("")
 
+    # Testing the fast sweep engine
+    print("TEST: scanBoxFast()")
+    box = findBounds([0,0], 200)
+    fast = scanBoxFast(box, "sonar")
+    print(f"    Contacts in 400x400 box : Expect roughly 96 : Got {len(fast)}")
+    print(f"    Repeatable              : Expect True       : Got {fast == scanBoxFast(box, 'sonar')}")
+    box = findBounds([10,-10], 20)
+    single = []
+    for y in range(box[1], box[3], -1):
+        for x in range(box[0], box[2]):
+            if hashRolls([x], [y], "radar")[0] <= 0.01:
+                single.append([x,y,"U"])
+    probs['chanceSurfacePOI'], saved = 0.01, probs['chanceSurfacePOI']
+    print(f"    Matches per-cell rolls  : Expect True       : Got {scanBoxFast(box, 'radar') == single}")
+    probs['chanceSurfacePOI'] = saved
+    print("")
+
+    # Testing delta sweeps
+    print("TEST: sensorSweep(delta=True)")
+    full  = sensorSweep([0,0], 50, "radar", delta=True)
+    same  = sensorSweep([0.2,0.2], 50, "radar", delta=True)
+    moved = sensorSweep([30,-12], 50, "radar", delta=True)
+    new   = [c for c in sensorSweep([30,-12], 50, "radar") if c not in full]
+    print(f"    First sweep         : Expected 4    : Got {len(full)}")
+    print(f"    Same grid square    : Expected 0    : Got {len(same)}")
+    print(f"    Only new contacts   : Expected True : Got {sorted(moved) == sorted(new)}")
+    resetSweeps()
+    print("")
+
+    # Testing the contact tile cache
+    print("TEST: scanBox() tile cache")
+    box = findBounds([-70.4,130.2], 50)
+    tileCache.clear()
+    tileStats.update(hits=0, misses=0)
+    cached = scanBox(box, "sonar")
+    print(f"    Matches engine      : Expected True : Got {cached == generateBox(box, 'sonar')}")
+    scanBox(box, "sonar")
+    print(f"    Cache stats         : Expected 4 hits, 4 misses, 4 tiles : Got {getCacheStats()}")
+    print("")
+
     # Testing getWeights()
     typeList = [ "island", "wreck", "coral" ]
     i = 0
@@ -184,6 +537,7 @@ if __name__ == "__main__":
 
     # Testing getPOI()
     print("TEST: getPOI()")
+    openMemo(":memory:")
     contact = (8, 8, "U")
     poiDetails = getPOI(contact)
     print(f"    Location:  {poiDetails['loc']}")
@@ -192,4 +546,9 @@ if __name__ == "__main__":
     print(f"    Adjective: {poiDetails['adj']}")
     print(f"    Weirdness: {poiDetails['weirdness']}")
     print(f"    Resources: {poiDetails['resources']}")
+    memoCache.clear()
+    print(f"    From memo: Expect True : Got {lookupPOI(contact) == poiDetails}")
+    rngs.rngMode = "streams" if rngs.rngMode == "compat" else "compat"
+    print(f"    Other RNG mode misses memo: Expect None : Got {lookupPOI(contact)}")
+    rngs.rngMode = conf.get('rngmode', "compat")
     print("")